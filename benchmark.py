@@ -0,0 +1,239 @@
+# benchmark.py - Offline extraction benchmarks on a seeded synthetic catalog
+#
+#   python benchmark.py                          # print results as JSON
+#   python benchmark.py --save-baseline base.json
+#   python benchmark.py --baseline base.json     # exit 1 on a regression
+#
+# Baselines are only comparable on the same machine and Python version.
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import httpx
+
+import extraction
+import main
+from normalize import normalize
+
+# Filler vocabulary that matches none of the extractors
+FILLER = [
+    "beautiful", "piece", "from", "our", "archive", "perfect", "for", "evening", "day", "wear",
+    "classic", "silhouette", "timeless", "elegant", "detail", "fits", "like", "modern", "size",
+    "measurements", "approximately", "shoulder", "length", "waist", "hip", "sleeve", "lined",
+    "closure", "zipper", "button", "pockets", "hand", "wash", "only", "made", "italy", "france",
+]
+ACCENTED = ["Hermès", "crêpe", "café", "naïve", "résumé", "Cristóbal", "Courrèges", "Jérôme", "déjà vu"]
+NOISE = ["SKU-{n:06d}", "#{n}", "{n}cm", "{n}\"", "Lot {n}", "★★★★☆", "✨", "👗", "—", "&amp;", "&nbsp;", "&#39;"]
+ERAS = ["1960s", "70s", "eighties", "'90s", "Y2K", "2000s", "1950's", "fall 2004", "SS19"]
+TAGS = ["p", "li", "span", "strong", "em", "div"]
+
+def _pick_case(rng: random.Random, phrase: str) -> str:
+    return rng.choice([phrase, phrase.lower(), phrase.upper(), phrase.title()])
+
+def generate_listing(rng: random.Random, sources: dict, product_id: int) -> dict:
+    """One product with a title and body_html of random (long-tailed) size."""
+    designer = rng.choice(sources["designer"] + list(sources["designer_synonym"]))
+    color = rng.choice(sources["color"])
+    material = rng.choice(sources["material"])
+    ptype = rng.choice(list(sources["product_type"]))
+    condition = rng.choice(list(sources["condition"]))
+
+    title_parts = [_pick_case(rng, designer), color, ptype]
+    if rng.random() < 0.5:
+        title_parts.insert(0, rng.choice(ERAS))
+    title = " ".join(title_parts)
+
+    # Body sizes from a few dozen bytes to tens of kilobytes
+    words = max(5, int(rng.lognormvariate(4.5, 1.0)))
+    pool = FILLER * 3 + ACCENTED + [material, condition, color.lower(), designer, ptype] + ERAS
+    body_words = []
+    for _ in range(words):
+        word = rng.choice(pool)
+        if rng.random() < 0.05:
+            word = rng.choice(NOISE).format(n=rng.randrange(1, 999999))
+        body_words.append(word)
+    paragraphs = []
+    for i in range(0, len(body_words), 40):
+        tag = rng.choice(TAGS)
+        paragraphs.append(f"<{tag}>{' '.join(body_words[i:i + 40])}</{tag}>")
+    if rng.random() < 0.3:
+        paragraphs.append('<script type="application/ld+json">{"@type": "Product"}</script>')
+    body_html = "<br>\n".join(paragraphs)
+
+    return {"id": product_id, "title": title, "body_html": body_html}
+
+def generate_listings(n: int, seed: int) -> list[dict]:
+    rng = random.Random(seed)
+    sources = extraction.load_sources()
+    return [generate_listing(rng, sources, 1_000_000 + i) for i in range(n)]
+
+def _ops_per_sec(fn, args: list, repeat: int) -> float:
+    """Best of repeat passes over args."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for a in args:
+            fn(*a)
+        best = min(best, time.perf_counter() - start)
+    return len(args) / best if best > 0 else float("inf")
+
+def _peak_bytes_per_op(fn, args: list) -> float:
+    """Mean peak memory traced during a single call."""
+    sample = args[: min(len(args), 200)]
+    total = 0
+    tracemalloc.start()
+    try:
+        for a in sample:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            fn(*a)
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return total / len(sample)
+
+def bench_extractors(listings: list[dict], repeat: int) -> dict:
+    """Each step build_metafields_payload runs, fed the same inputs it would see."""
+    texts = [main.product_text(p["title"], p["body_html"]) for p in listings]
+    vocab = extraction.get_vocabulary()
+    normalized = [normalize(t) for t in texts]
+    hits = [vocab.scan(n.text) for n in normalized]
+    with_hits = list(zip(normalized, hits))
+
+    cases = {
+        "product_text": (main.product_text, [(p["title"], p["body_html"]) for p in listings]),
+        "normalize": (normalize, [(t,) for t in texts]),
+        "phrase_scan": (vocab.scan, [(n.text,) for n in normalized]),
+        "extract_designer": (extraction.extract_designer, with_hits),
+        "extract_condition": (extraction.extract_condition, with_hits),
+        "extract_colors": (extraction.extract_colors, with_hits),
+        "extract_type": (extraction.extract_type, with_hits),
+        "extract_era": (extraction.extract_era, [(n,) for n in normalized]),
+        "extract_materials": (extraction.extract_materials, with_hits),
+        "extract_metafields": (extraction.extract_metafields, with_hits),
+        "build_metafields_payload": (main.build_metafields_payload,
+                                     [(p["id"], t) for p, t in zip(listings, texts)]),
+    }
+
+    # Measure extraction itself, not the result cache
+    cache = main.extraction_cache
+    main.extraction_cache = main.Cache(0)
+    try:
+        results = {}
+        for name, (fn, args) in cases.items():
+            results[name] = {
+                "ops_per_sec": round(_ops_per_sec(fn, args, repeat), 1),
+                "peak_bytes_per_op": round(_peak_bytes_per_op(fn, args), 1),
+            }
+    finally:
+        main.extraction_cache = cache
+    return results
+
+async def _post_webhooks(listings: list[dict]) -> float:
+    secret = main.SHOPIFY_SECRET.encode()
+    requests = []
+    for p in listings:
+        body = json.dumps(p).encode()
+        signature = base64.b64encode(hmac.new(secret, body, hashlib.sha256).digest()).decode()
+        requests.append((body, {"x-shopify-hmac-sha256": signature, "content-type": "application/json"}))
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        for body, headers in requests:
+            resp = await client.post("/webhooks/products", content=body, headers=headers)
+            resp.raise_for_status()
+        return time.perf_counter() - start
+
+def bench_webhook(listings: list[dict], repeat: int) -> dict:
+    """HMAC check through extraction for each product, with the Shopify writer stubbed out."""
+    async def stub_writer(product_id: int, metafields: list[dict]) -> list[dict]:
+        return [{"key": mf["key"], "ok": True, "error": None} for mf in metafields]
+
+    saved = (main.SHOPIFY_SECRET, main.write_metafields_to_shopify, main.extraction_cache,
+             main.written_fingerprints)
+    main.SHOPIFY_SECRET = "benchmark"
+    main.write_metafields_to_shopify = stub_writer
+    try:
+        best = float("inf")
+        for _ in range(repeat):
+            # Fresh caches each pass, so no pass is answered by the dedup/echo/result caches
+            main.extraction_cache = main.Cache(0)
+            main.written_fingerprints = main.Cache(main.ECHO_CACHE_SIZE, main.ECHO_TTL)
+            best = min(best, asyncio.run(_post_webhooks(listings)))
+    finally:
+        (main.SHOPIFY_SECRET, main.write_metafields_to_shopify, main.extraction_cache,
+         main.written_fingerprints) = saved
+    return {"webhook_end_to_end": {"ops_per_sec": round(len(listings) / best, 1)}}
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Benchmarks whose throughput fell more than tolerance below the baseline."""
+    regressions = []
+    for key in ("seed", "listings", "python"):
+        if results["meta"][key] != baseline["meta"].get(key):
+            print(f"warning: baseline {key} is {baseline['meta'].get(key)!r}, not {results['meta'][key]!r}",
+                  file=sys.stderr)
+    for name, base in baseline["benchmarks"].items():
+        current = results["benchmarks"].get(name)
+        if current is None:
+            continue
+        if current["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {current['ops_per_sec']:.0f} ops/s vs baseline {base['ops_per_sec']:.0f}"
+            )
+    return regressions
+
+def run(n: int, seed: int, repeat: int) -> dict:
+    listings = generate_listings(n, seed)
+    benchmarks = bench_extractors(listings, repeat)
+    benchmarks.update(bench_webhook(listings, repeat))
+    return {
+        "meta": {
+            "seed": seed,
+            "listings": n,
+            "repeat": repeat,
+            "corpus_bytes": sum(len(p["title"]) + len(p["body_html"]) for p in listings),
+            "vocabulary_version": extraction.get_vocabulary().version,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        },
+        "benchmarks": benchmarks,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline extraction benchmarks on a seeded synthetic catalog")
+    parser.add_argument("--listings", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--repeat", type=int, default=3, help="passes per benchmark; the best is kept")
+    parser.add_argument("--output", help="write results JSON here instead of stdout")
+    parser.add_argument("--save-baseline", metavar="PATH", help="also store the results as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="compare against a stored baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed throughput drop (0.15 = 15%%)")
+    args = parser.parse_args()
+
+    results = run(args.listings, args.seed, args.repeat)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            f.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,259 @@
+# bulk_jobs.py - Background bulk runs with progress reporting and cancellation
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List
+
+# Per-product errors kept for reporting; the failed count has them all
+MAX_REPORTED_ERRORS = 50
+# Finished jobs kept for GET /jobs/{id}, oldest dropped first
+MAX_FINISHED_JOBS = 100
+# Result records buffered for a streaming response before the run waits for the client
+RESULT_STREAM_BUFFER = 100
+
+class Progress:
+    """Counters for one bulk run, updated by the pipeline stages as they go."""
+
+    def __init__(self):
+        self.total: int | None = None  # products expected, when Shopify could count them
+        self.done_before = 0           # products settled by an earlier attempt of a resumed run
+        self.fetched = 0
+        self.skipped = 0              # unchanged since their last write (incremental runs)
+        self.extracted = 0
+        self.processed = 0
+        self.metafield_writes = 0
+        self.unchanged = 0            # metafields that already had the extracted value
+        self.failed = 0
+        self.errors: List[Dict] = []
+        self.started = time.monotonic()
+        self.stopped: float | None = None
+
+    def record(self, result: Dict):
+        """Count one product's write result (as returned by write_product)."""
+        self.processed += 1
+        self.metafield_writes += result["success_count"] - result["unchanged_count"]
+        self.unchanged += result["unchanged_count"]
+        if result["errors"]:
+            self.failed += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({"product_id": result["product_id"], "errors": result["errors"]})
+
+    def stop(self):
+        self.stopped = time.monotonic()
+
+    def report(self) -> Dict:
+        elapsed = (self.stopped or time.monotonic()) - self.started
+        settled = self.processed + self.skipped
+        rate = settled / elapsed if elapsed > 0 else 0.0
+        done = self.done_before + settled
+        eta = None
+        if self.total is not None and self.stopped is None and rate > 0:
+            eta = round(max(0, self.total - done) / rate, 1)
+        return {
+            "total": self.total,
+            "done": done,
+            "percent": round(100 * done / self.total, 1) if self.total else None,
+            "fetched": self.fetched,
+            "skipped": self.skipped,
+            "extracted": self.extracted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "metafield_writes": self.metafield_writes,
+            "unchanged_metafields": self.unchanged,
+            "elapsed_seconds": round(elapsed, 1),
+            "products_per_sec": round(rate, 2),
+            "writes_per_sec": round(self.metafield_writes / elapsed, 2) if elapsed > 0 else 0.0,
+            "eta_seconds": eta,
+            "errors": self.errors,
+        }
+
+class ResultLog:
+    """Records appended to a JSONL file as they arrive, rotated at max_bytes.
+
+    Lines are flushed one by one, so `tail -F` follows a run live. Rotation
+    keeps backups older files as path.1 (newest) to path.N.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 0, backups: int = 0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def write(self, record: Dict):
+        line = json.dumps(record) + "\n"
+        if self.max_bytes and 0 < self._file.tell() and self._file.tell() + len(line) > self.max_bytes:
+            self._rotate()
+        self._file.write(line)
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, "w", encoding="utf-8", buffering=1)
+
+    def close(self):
+        self._file.close()
+
+class ResultStream:
+    """Hands result records to one streaming response, ending with the summary.
+
+    At most RESULT_STREAM_BUFFER records wait for the client; once it goes
+    away the stream is closed and records are dropped.
+    """
+
+    def __init__(self, maxsize: int = RESULT_STREAM_BUFFER):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.closed = False
+
+    async def put(self, record: Dict | None):
+        if not self.closed:
+            await self._queue.put(record)
+
+    def close(self):
+        self.closed = True
+        while not self._queue.empty():
+            self._queue.get_nowait()
+
+    async def __aiter__(self):
+        while (record := await self._queue.get()) is not None:
+            yield record
+
+class Job:
+    """One background bulk run.
+
+    Per-product results go to the job's ResultLog and, while a client is
+    attached, its ResultStream; only counters are kept in memory.
+    """
+
+    def __init__(self, store: str, params: Dict):
+        self.id = uuid.uuid4().hex[:12]
+        self.store = store
+        self.params = params
+        self.status = "running"       # running, cancelling, complete, failed, cancelled
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+        self.progress = Progress()
+        self.result: Dict | None = None
+        self.error: str | None = None
+        self.task: asyncio.Task | None = None
+        self.log: ResultLog | None = None
+        self.stream: ResultStream | None = None
+
+    async def publish(self, result: Dict):
+        """Pass one product's result on to the log and the attached stream."""
+        record = {"type": "product", **result}
+        if self.log is not None:
+            self.log.write(record)
+        if self.stream is not None:
+            await self.stream.put(record)
+
+    async def finish(self):
+        """End the log and stream with a summary record."""
+        summary = {"type": "summary", **self.report()}
+        if self.log is not None:
+            self.log.write(summary)
+            self.log.close()
+        if self.stream is not None:
+            await self.stream.put(summary)
+            await self.stream.put(None)
+
+    def report(self) -> Dict:
+        report = {
+            "id": self.id,
+            "store": self.store,
+            "status": self.status,
+            "params": self.params,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress.report(),
+            "error": self.error,
+            "results_file": self.log.path if self.log is not None else None,
+        }
+        if self.result is not None:
+            report["result"] = self.result
+        return report
+
+class JobConflict(Exception):
+    """A job is already running for the store."""
+
+    def __init__(self, job: Job):
+        super().__init__(f"Job {job.id} is already running for {job.store}")
+        self.job = job
+
+class JobRegistry:
+    """Jobs of this process, at most one running per store.
+
+    With a results_dir each job's results are logged to
+    results_dir/job-<id>.jsonl (see ResultLog).
+    """
+
+    def __init__(self, results_dir: str = "", max_bytes: int = 0, backups: int = 0):
+        self.jobs: Dict[str, Job] = {}
+        self.results_dir = results_dir
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def active(self, store: str) -> Job | None:
+        for job in self.jobs.values():
+            if job.store == store and job.finished_at is None:
+                return job
+        return None
+
+    def start(self, store: str, params: Dict, run: Callable[[Job], Awaitable[Dict]]) -> Job:
+        """Run run(job) in the background; raises JobConflict if the store is busy."""
+        active = self.active(store)
+        if active is not None:
+            raise JobConflict(active)
+        job = Job(store, params)
+        if self.results_dir:
+            job.log = ResultLog(os.path.join(self.results_dir, f"job-{job.id}.jsonl"), self.max_bytes, self.backups)
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+        self._prune()
+        return job
+
+    async def _run(self, job: Job, run: Callable[[Job], Awaitable[Dict]]):
+        try:
+            job.result = await run(job)
+            job.status = "failed" if job.result.get("error") else "complete"
+            job.error = job.result.get("error")
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = repr(e)
+            print(f"❌ Job {job.id} failed: {e!r}")
+        finally:
+            job.finished_at = time.time()
+            job.progress.stop()
+            await job.finish()
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job | None:
+        job = self.jobs.get(job_id)
+        if job is not None and job.finished_at is None:
+            job.status = "cancelling"
+            job.task.cancel()
+        return job
+
+    async def shutdown(self):
+        """Cancel running jobs and wait for them to stop."""
+        tasks = [job.task for job in self.jobs.values() if job.finished_at is None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished_at is not None]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job_id]
@@ -3,208 +3,655 @@
 import os
 import asyncio
 import httpx
-import re
 import json
-from typing import List, Dict
-from fastapi import FastAPI
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, List, Dict
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
 
-app = FastAPI()
+from bulk_jobs import Job, JobConflict, JobRegistry, Progress, ResultStream
+from bulk_state import RunState, StoredValues
+from catalog import PRODUCT_FIELDS, ProductRecord
+from extraction import extract_batch
+from metrics import CONTENT_TYPE, IN_FLIGHT, STAGE_SECONDS, render as render_metrics
+from shopify_client import (
+    METAFIELDS_SET_MUTATION, admin_url, get_client, graphql, lifespan, metafields_set_results, plan_writes,
+    shopify_request, write_changed_metafields,
+)
+
+@asynccontextmanager
+async def app_lifespan(app):
+    """Open the shared HTTP client; cancel running jobs at shutdown (checkpointed runs resume later)."""
+    async with lifespan(app):
+        try:
+            yield
+        finally:
+            await jobs.shutdown()
+
+app = FastAPI(lifespan=app_lifespan)
 
 # Environment variables (set in Render dashboard)
 SHOPIFY_API_TOKEN = os.environ.get("SHOPIFY_API_TOKEN", "")
 SHOPIFY_STORE_DOMAIN = os.environ.get("SHOPIFY_STORE_DOMAIN", "")
 
-# Copy all your extraction data from the webhook here...
-DESIGNERS = [
-    "Yves Saint Laurent", "Christian Dior", "Cartier", "Louis Vuitton", "Bottega Veneta",
-    # ... add all 200+ designers from your webhook
-]
+# Extraction worker processes (0 = extract on the event loop) and the most
+# products per task; smaller batches are split so every worker gets a share
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", "0"))
+EXTRACT_CHUNK_SIZE = int(os.environ.get("EXTRACT_CHUNK_SIZE", "500"))
+# Most worker processes a request's ?workers= may ask for (default: one per core)
+MAX_EXTRACT_WORKERS = int(os.environ.get("MAX_EXTRACT_WORKERS", str(max(EXTRACT_WORKERS, os.cpu_count() or 1))))
+
+# Streaming pipeline: pages buffered between fetch and extract, products
+# buffered between extract and write, and concurrent tasks per stage
+PAGE_QUEUE_SIZE = int(os.environ.get("PAGE_QUEUE_SIZE", "2"))
+WRITE_QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", "250"))
+EXTRACT_CONCURRENCY = int(os.environ.get("EXTRACT_CONCURRENCY", "1"))
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "1"))
+
+# SQLite file holding bulk run checkpoints (empty disables checkpointing);
+# point it at a persistent disk so runs survive a redeploy
+BULK_STATE_DB = os.environ.get("BULK_STATE_DB", "bulk_state.sqlite3")
+
+# Incremental runs re-list products updated this many seconds before the last
+# run started, so clock skew and in-flight edits are not missed
+INCREMENTAL_OVERLAP = int(os.environ.get("INCREMENTAL_OVERLAP", "300"))
+
+# Each job's per-product results are appended here as job-<id>.jsonl (empty
+# disables); files rotate at RESULTS_FILE_MAX_BYTES keeping that many backups
+BULK_RESULTS_DIR = os.environ.get("BULK_RESULTS_DIR", "bulk_results")
+RESULTS_FILE_MAX_BYTES = int(os.environ.get("RESULTS_FILE_MAX_BYTES", str(100 * 1024 * 1024)))
+RESULTS_FILE_BACKUPS = int(os.environ.get("RESULTS_FILE_BACKUPS", "5"))
 
-DESIGNER_SYNONYMS = {
-    "cartier": "Cartier",
-    "lv": "Louis Vuitton",
-    # ... add all synonyms from your webhook
+# Products per page when listing the catalog. Every page costs one call from
+# the REST bucket whatever its size, so the API maximum spends the least budget
+PAGE_LIMIT = 250
+
+# Seconds between bulk operation status polls
+BULK_POLL_INTERVAL = float(os.environ.get("BULK_POLL_INTERVAL", "5"))
+
+jobs = JobRegistry(BULK_RESULTS_DIR, RESULTS_FILE_MAX_BYTES, RESULTS_FILE_BACKUPS)
+
+BULK_PRODUCTS_QUERY = """
+{
+  products {
+    edges {
+      node {
+        id title descriptionHtml updatedAt
+        metafields(namespace: "custom") { edges { node { key value } } }
+      }
+    }
+  }
 }
+"""
 
-CONDITION_MAP = {
-    "very good pre-owned condition": "VERY GOOD",
-    # ... add all conditions from your webhook
+BULK_RUN_QUERY = """
+mutation RunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
 }
+"""
 
-COLORS = ["Black", "White", "Platinum", "Gold", "Eggplant"]  # Add all 170+ colors
-PRODUCT_TYPES = {"ring": "Ring", "diamond ring": "Ring"}  # Add all types
-MATERIALS = ["Platinum", "Gold", "Diamond", "Leather"]  # Add all materials
-
-def extract_designer(text: str) -> str:
-    text_l = text.lower()
-    for syn, canonical in DESIGNER_SYNONYMS.items():
-        if syn in text_l:
-            return canonical
-    for designer in sorted(DESIGNERS, key=len, reverse=True):
-        if designer.lower() in text_l:
-            return designer
-    return "unbranded"
-
-def extract_condition(text: str) -> str | None:
-    t = text.lower()
-    for phrase in sorted(CONDITION_MAP.keys(), key=len, reverse=True):
-        if phrase in t:
-            return CONDITION_MAP[phrase]
-    return None
-
-def extract_colors(text: str) -> list[str]:
-    t = text.lower()
-    found = []
-    for c in sorted(COLORS, key=len, reverse=True):
-        if c.lower() in t:
-            found.append(c)
-    return list(dict.fromkeys(found))
-
-def extract_type(text: str) -> str | None:
-    t = text.lower()
-    for phrase in sorted(PRODUCT_TYPES.keys(), key=len, reverse=True):
-        escaped_phrase = re.escape(phrase)
-        if ' ' in phrase:
-            pattern = r'\b' + escaped_phrase.replace(r'\ ', r'\s+') + r'\b'
-        else:
-            pattern = r'\b' + escaped_phrase + r'\b'
-        if re.search(pattern, t):
-            return PRODUCT_TYPES[phrase]
-    return None
-
-def extract_materials(text: str) -> list[str]:
-    t = text.lower()
-    found = []
-    for m in sorted(MATERIALS, key=len, reverse=True):
-        if m.lower() in t:
-            found.append(m)
-    return list(dict.fromkeys(found))
-
-async def fetch_all_products() -> List[Dict]:
-    """Fetch all products from Shopify."""
-    products = []
-    url = f"https://{SHOPIFY_STORE_DOMAIN}/admin/api/2025-10/products.json?limit=250"
+BULK_RUN_MUTATION = """
+mutation RunMutation($mutation: String!, $path: String!) {
+  bulkOperationRunMutation(mutation: $mutation, stagedUploadPath: $path) {
+    bulkOperation { id status }
+    userErrors { field message }
+  }
+}
+"""
+
+BULK_OPERATION_STATUS = """
+query BulkOperationStatus($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation { id status errorCode objectCount url }
+  }
+}
+"""
+
+STAGED_UPLOADS_CREATE = """
+mutation StagedUploadsCreate($input: [StagedUploadInput!]!) {
+  stagedUploadsCreate(input: $input) {
+    stagedTargets { url resourceUrl parameters { name value } }
+    userErrors { field message }
+  }
+}
+"""
+
+def updated_since(timestamp: float) -> str:
+    """updated_at_min value for products changed since timestamp, less the overlap."""
+    since = datetime.fromtimestamp(timestamp - INCREMENTAL_OVERLAP, tz=timezone.utc)
+    return since.isoformat(timespec="seconds")
+
+async def iter_product_pages(client: httpx.AsyncClient, url: str | None = None,
+                             updated_at_min: str | None = None
+                             ) -> AsyncIterator[tuple[List[ProductRecord], str | None]]:
+    """Yield (products, next page URL) one page at a time, starting at url.
+    
+    Only PRODUCT_FIELDS are requested, and each page's JSON is dropped once
+    it is turned into records. With updated_at_min only products updated
+    since then are listed, paged by since_id so the listing stays stable
+    while products keep changing.
+    """
+    if url is None:
+        url = f"{admin_url(SHOPIFY_STORE_DOMAIN)}/products.json?limit={PAGE_LIMIT}"
+        if updated_at_min:
+            url = str(httpx.URL(url).copy_merge_params({"updated_at_min": updated_at_min, "since_id": 0}))
     headers = {
         "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
         "Content-Type": "application/json",
     }
+    fields = ",".join(PRODUCT_FIELDS)
     
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        while url:
-            resp = await client.get(url, headers=headers)
-            if resp.status_code != 200:
-                break
-            
-            data = resp.json()
-            batch = data.get("products", [])
-            products.extend(batch)
-            
-            # Check for next page
-            link_header = resp.headers.get("Link", "")
-            if 'rel="next"' in link_header:
-                next_link = [l.strip() for l in link_header.split(",") if 'rel="next"' in l]
-                if next_link:
-                    url = next_link[0].split(";")[0].strip("<>")
-                else:
-                    url = None
+    while url:
+        # Set on every page: next-page links don't always carry it over
+        url = str(httpx.URL(url).copy_set_param("fields", fields))
+        resp = await shopify_request(client, "GET", url, headers=headers)
+        if resp.status_code != 200:
+            break
+        
+        batch = [ProductRecord.from_json(p) for p in resp.json().get("products", [])]
+        
+        # Check for next page
+        link_header = resp.headers.get("Link", "")
+        if "since_id=" in url:
+            # A short page is the last one
+            if len(batch) < PAGE_LIMIT:
+                url = None
+            else:
+                url = str(httpx.URL(url).copy_set_param("since_id", batch[-1].id))
+        elif 'rel="next"' in link_header:
+            next_link = [l.strip() for l in link_header.split(",") if 'rel="next"' in l]
+            if next_link:
+                url = next_link[0].split(";")[0].strip("<>")
             else:
                 url = None
-            
-            await asyncio.sleep(0.5)
-    
+        else:
+            url = None
+        
+        yield batch, url
+
+async def count_products(client: httpx.AsyncClient, updated_at_min: str | None = None) -> int | None:
+    """Number of products a listing will return, or None if Shopify won't say."""
+    params = {"updated_at_min": updated_at_min} if updated_at_min else {}
+    resp = await shopify_request(
+        client, "GET", f"{admin_url(SHOPIFY_STORE_DOMAIN)}/products/count.json",
+        headers={"X-Shopify-Access-Token": SHOPIFY_API_TOKEN}, params=params,
+    )
+    if resp.status_code != 200:
+        return None
+    return resp.json().get("count")
+
+async def fetch_all_products(updated_at_min: str | None = None) -> List[ProductRecord]:
+    """Fetch all products from Shopify, or only those updated since updated_at_min."""
+    products = []
+    async for batch, _ in iter_product_pages(get_client(), updated_at_min=updated_at_min):
+        products.extend(batch)
     return products
 
-async def process_product(product: Dict, client: httpx.AsyncClient):
-    """Process a single product."""
-    product_id = product.get("id")
-    title = product.get("title", "")
-    body_html = product.get("body_html", "")
-    
-    body_text = re.sub(r"<[^>]+>", " ", body_html or "")
-    text = f"{title}\n{body_text}"
-    
-    # Extract metadata
-    designer = extract_designer(text)
-    condition = extract_condition(text)
-    colors = extract_colors(text)
-    ptype = extract_type(text)
-    materials = extract_materials(text)
-    
-    # Build metafields
-    metafields = []
-    
-    def add_field(key: str, value):
-        if value is None:
-            return
-        metafields.append({
-            "namespace": "custom",
-            "key": key,
-            "type": "single_line_text_field",
-            "value": str(value),
-        })
-    
-    add_field("designer", designer)
-    add_field("condition_rating", condition)
-    if colors:
-        add_field("color", colors[0])
-    add_field("product_type", ptype)
-    if materials:
-        add_field("material", ", ".join(materials))
-    
-    # Write metafields
-    base_url = f"https://{SHOPIFY_STORE_DOMAIN}/admin/api/2025-10/products/{product_id}/metafields.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-        "Content-Type": "application/json",
-    }
+def extract_chunk(products: List[ProductRecord]) -> List[Dict]:
+    """Extract a chunk of products; runs inside pool workers."""
+    return extract_batch((product.id, product.title, product.body_html) for product in products)
+
+async def extract_products(products: List[ProductRecord], pool: ProcessPoolExecutor | None = None,
+                           chunk_size: int = EXTRACT_CHUNK_SIZE, workers: int = 1) -> List[Dict]:
+    """Extract products, fanning chunks out to the process pool when given one.
     
-    success_count = 0
-    for mf in metafields:
-        payload = {"metafield": mf}
-        resp = await client.post(base_url, headers=headers, json=payload)
-        
-        if resp.status_code < 300:
-            success_count += 1
-        
-        await asyncio.sleep(2.0)  # Extra safe rate limiting
+    Products are split into at least one chunk per worker (of the pool's
+    workers), so a single page keeps the whole pool busy. Results come back
+    in the same order as products. Per-extractor timings are only recorded
+    when extracting in this process.
+    """
+    if pool is None:
+        with STAGE_SECONDS.time(stage="extract_page"):
+            return extract_chunk(products)
+    
+    # Only ship the fields extraction reads, not an export's current metafields
+    slim = [ProductRecord(p.id, p.title, p.body_html) for p in products]
+    chunk_size = max(1, min(chunk_size, -(-len(slim) // max(1, workers))))
+    chunks = [slim[i:i + chunk_size] for i in range(0, len(slim), chunk_size)]
+    
+    loop = asyncio.get_running_loop()
+    with STAGE_SECONDS.time(stage="extract_page"):
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, extract_chunk, chunk) for chunk in chunks
+        ))
+    return [item for chunk in results for item in chunk]
+
+async def write_product(extracted: Dict, client: httpx.AsyncClient, values: StoredValues | None = None):
+    """Write one product's extracted metafields to Shopify.
+    
+    With values (a run state's store) unchanged fields are recognised from
+    what earlier runs wrote, even across restarts.
+    """
+    metafields = extracted["metafields"]
+    
+    results = await write_changed_metafields(
+        client, SHOPIFY_STORE_DOMAIN, SHOPIFY_API_TOKEN, extracted["product_id"], metafields,
+        values=values,
+    )
     
     return {
-        "product": title,
-        "success_count": success_count,
-        "total_fields": len(metafields)
+        "product_id": extracted["product_id"],
+        "product": extracted["title"],
+        "success_count": sum(1 for r in results if r["ok"]),
+        "unchanged_count": sum(1 for r in results if r.get("skipped")),
+        "total_fields": len(metafields),
+        "errors": {r["key"]: r["error"] for r in results if not r["ok"]},
     }
 
+async def process_product(product: ProductRecord, client: httpx.AsyncClient):
+    """Process a single product."""
+    return await write_product(extract_chunk([product])[0], client)
+
 @app.get("/")
 async def root():
-    return {"message": "Bulk processor ready. Visit /process to start processing."}
+    return {"message": "Bulk processor ready. POST /jobs to start processing."}
 
-@app.get("/process")
-async def process_all_products():
-    """Endpoint to trigger bulk processing."""
+@app.get("/metrics")
+def metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
+
+async def run_pipeline(workers: int = EXTRACT_WORKERS,
+                       extract_concurrency: int = EXTRACT_CONCURRENCY,
+                       write_concurrency: int = WRITE_CONCURRENCY,
+                       state: RunState | None = None,
+                       run: Dict | None = None,
+                       updated_at_min: str | None = None,
+                       progress: Progress | None = None,
+                       on_result: Callable[[Dict], Awaitable[None]] | None = None):
+    """Stream the catalog through fetch -> extract -> write stages.
+    
+    Bounded queues join the stages, so at most a few pages are held in memory
+    and the first products are written while later pages are still downloading.
+    With a state store every stage checkpoints its progress under run["run_id"],
+    and a resumed run replays unfinished products before paging on from its cursor.
+    An incremental run lists products updated_at_min onwards and drops those whose
+    title and body are unchanged since they were last written.
+    Counts go to progress as each stage advances, and each product's write
+    result is handed to on_result as it completes rather than collected.
+    """
+    pages: asyncio.Queue = asyncio.Queue(maxsize=PAGE_QUEUE_SIZE)
+    items: asyncio.Queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+    progress = progress or Progress()
+    run_id = run["run_id"] if run else None
+    IN_FLIGHT.set_function(pages.qsize, stage="pages_queued")
+    IN_FLIGHT.set_function(items.qsize, stage="products_queued")
+    
+    async def fetch_stage(client: httpx.AsyncClient):
+        if state is not None:
+            for page in state.fetched_pages(run_id):
+                await pages.put(page)
+        if not (run and run["fetch_done"]):
+            async for page, next_url in iter_product_pages(client, run and run["cursor"], updated_at_min):
+                progress.fetched += len(page)
+                if state is not None:
+                    if run["incremental"]:
+                        listed = len(page)
+                        page = state.changed(page)
+                        progress.skipped += listed - len(page)
+                    state.record_page(run_id, page, next_url)
+                if page:
+                    await pages.put(page)
+        for _ in range(extract_concurrency):
+            await pages.put(None)
+    
+    async def extract_worker(pool: ProcessPoolExecutor | None):
+        while (page := await pages.get()) is not None:
+            extracted = await extract_products(page, pool, workers=workers)
+            progress.extracted += len(extracted)
+            if state is not None:
+                state.mark_extracted(run_id, extracted)
+            for item in extracted:
+                await items.put(item)
+    
+    async def extract_stage(pool: ProcessPoolExecutor | None):
+        # Products extracted before an interruption go straight to the writers
+        if state is not None:
+            for item in state.extracted_items(run_id):
+                await items.put(item)
+        await asyncio.gather(*(extract_worker(pool) for _ in range(extract_concurrency)))
+        for _ in range(write_concurrency):
+            await items.put(None)
+    
+    async def write_worker(client: httpx.AsyncClient):
+        while (item := await items.get()) is not None:
+            print(f"🔄 Processing {progress.processed + 1}: {item['title']}")
+            with IN_FLIGHT.track_inprogress(stage="product_write"):
+                result = await write_product(item, client, state.written_values if state is not None else None)
+            if state is not None:
+                state.mark_written(run_id, item["product_id"], result["errors"])
+            progress.record(result)
+            if on_result is not None:
+                await on_result(result)
+    
+    # Workers live for the whole run, so vocabularies are loaded once per worker
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    try:
+        client = get_client()
+        tasks = [
+            asyncio.create_task(fetch_stage(client)),
+            asyncio.create_task(extract_stage(pool)),
+            *(asyncio.create_task(write_worker(client)) for _ in range(write_concurrency)),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+class BulkOperationError(Exception):
+    """A Shopify bulk operation could not be started or did not complete."""
+
+async def run_bulk_operation(client: httpx.AsyncClient, mutation: str, variables: Dict, field: str) -> Dict:
+    """Start a bulk operation, poll it until it finishes and return its final state."""
+    body = await graphql(client, SHOPIFY_STORE_DOMAIN, SHOPIFY_API_TOKEN, mutation, variables)
+    outcome = (body.get("data") or {}).get(field) or {}
+    if body.get("errors") or outcome.get("userErrors") or not outcome.get("bulkOperation"):
+        raise BulkOperationError(f"{field} failed: {body.get('errors') or outcome.get('userErrors')}")
+    operation_id = outcome["bulkOperation"]["id"]
+    print(f"⏳ Bulk operation {operation_id} started")
+    
+    while True:
+        await asyncio.sleep(BULK_POLL_INTERVAL)
+        body = await graphql(client, SHOPIFY_STORE_DOMAIN, SHOPIFY_API_TOKEN,
+                             BULK_OPERATION_STATUS, {"id": operation_id}, cost=1.0)
+        operation = (body.get("data") or {}).get("node") or {}
+        status = operation.get("status")
+        if status == "COMPLETED":
+            return operation
+        if status in ("FAILED", "CANCELED", "EXPIRED"):
+            raise BulkOperationError(f"Bulk operation {operation_id} {status}: {operation.get('errorCode')}")
+
+async def iter_jsonl(client: httpx.AsyncClient, url: str | None) -> AsyncIterator[Dict]:
+    """Stream a bulk operation result file, one JSON object per line."""
+    if not url:  # no objects matched
+        return
+    async with client.stream("GET", url) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+async def iter_bulk_products(client: httpx.AsyncClient) -> AsyncIterator[ProductRecord]:
+    """Yield every product from a bulkOperationRunQuery export.
+    
+    Each product carries its current custom metafields as current_metafields.
+    """
+    operation = await run_bulk_operation(
+        client, BULK_RUN_QUERY, {"query": BULK_PRODUCTS_QUERY}, "bulkOperationRunQuery",
+    )
+    print(f"📦 Bulk export ready: {operation.get('objectCount')} objects")
+    product = None
+    product_gid = None
+    async for row in iter_jsonl(client, operation.get("url")):
+        # Metafield rows follow their product, linked by __parentId
+        if "__parentId" in row:
+            if product is not None and row["__parentId"] == product_gid:
+                product.current_metafields[row["key"]] = row["value"]
+            else:
+                print(f"⚠️ Metafield row for {row['__parentId']} outside its product; ignored")
+            continue
+        if product is not None:
+            yield product
+        product_gid = row["id"]
+        product = ProductRecord(
+            int(row["id"].rsplit("/", 1)[-1]),
+            row.get("title") or "",
+            row.get("descriptionHtml") or "",
+            row.get("updatedAt"),
+            current_metafields={},
+        )
+    if product is not None:
+        yield product
+
+async def upload_bulk_variables(client: httpx.AsyncClient, path: str) -> str:
+    """Upload a JSONL variables file; returns the stagedUploadPath for the mutation."""
+    body = await graphql(client, SHOPIFY_STORE_DOMAIN, SHOPIFY_API_TOKEN, STAGED_UPLOADS_CREATE, {
+        "input": [{
+            "resource": "BULK_MUTATION_VARIABLES",
+            "filename": os.path.basename(path),
+            "mimeType": "text/jsonl",
+            "httpMethod": "POST",
+        }],
+    })
+    outcome = (body.get("data") or {}).get("stagedUploadsCreate") or {}
+    if body.get("errors") or outcome.get("userErrors") or not outcome.get("stagedTargets"):
+        raise BulkOperationError(f"stagedUploadsCreate failed: {body.get('errors') or outcome.get('userErrors')}")
+    target = outcome["stagedTargets"][0]
+    params = {p["name"]: p["value"] for p in target["parameters"]}
+    
+    with open(path, "rb") as fh:
+        resp = await client.post(target["url"], data=params,
+                                 files={"file": (os.path.basename(path), fh, "text/jsonl")})
+    if resp.status_code >= 300:
+        raise BulkOperationError(f"Staged upload failed: {resp.status_code} {resp.text}")
+    return params["key"]
+
+async def run_bulk_backfill(workers: int = EXTRACT_WORKERS, progress: Progress | None = None,
+                            on_result: Callable[[Dict], Awaitable[None]] | None = None) -> Dict:
+    """Backfill the whole catalog with one bulk query and one bulk mutation.
+    
+    Products are streamed from the export file, extracted in chunks and
+    written as metafieldsSet variables to a local JSONL file, which is
+    uploaded and applied with bulkOperationRunMutation. Each row of the
+    mutation's result file becomes one write_product-style result, counted
+    in progress and handed to on_result.
+    """
+    progress = progress or Progress()
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+    total = 0
+    unchanged = 0
+    owners: List[tuple] = []  # (product id, title, keys written, unchanged count) per JSONL line
+    try:
+        client = get_client()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metafields.jsonl")
+            with open(path, "w", encoding="utf-8") as out:
+                chunk: List[Dict] = []
+                
+                async def flush():
+                    nonlocal unchanged
+                    current = {p.id: p.current_metafields for p in chunk}
+                    for item in await extract_products(chunk, pool, workers=workers):
+                        progress.extracted += 1
+                        # Only submit fields whose value differs from the export
+                        changed = plan_writes(item["metafields"], current[item["product_id"]])
+                        if not changed:
+                            unchanged += 1
+                            progress.skipped += 1
+                            continue
+                        owner_id = f"gid://shopify/Product/{item['product_id']}"
+                        out.write(json.dumps({"metafields": [
+                            {"ownerId": owner_id, **mf} for mf in changed
+                        ]}) + "\n")
+                        owners.append((item["product_id"], item["title"], [mf["key"] for mf in changed],
+                                       len(item["metafields"]) - len(changed)))
+                    chunk.clear()
+                
+                async for product in iter_bulk_products(client):
+                    total += 1
+                    progress.fetched += 1
+                    chunk.append(product)
+                    if len(chunk) >= EXTRACT_CHUNK_SIZE:
+                        await flush()
+                await flush()
+            
+            if not owners:
+                return {"status": "complete", "mode": "bulk", "total_products": total,
+                        "unchanged": unchanged, "submitted": 0}
+            
+            print(f"📤 Uploading metafields for {len(owners)} products")
+            staged_path = await upload_bulk_variables(client, path)
+        
+        operation = await run_bulk_operation(
+            client, BULK_RUN_MUTATION,
+            {"mutation": METAFIELDS_SET_MUTATION, "path": staged_path}, "bulkOperationRunMutation",
+        )
+        
+        failed_before = progress.failed
+        errors_before = len(progress.errors)
+        async for row in iter_jsonl(client, operation.get("url")):
+            line = row.get("__lineNumber")
+            if not isinstance(line, int) or not 0 <= line < len(owners):
+                print(f"⚠️ Bulk mutation result without a known line: {row}")
+                continue
+            product_id, title, keys, unchanged_count = owners[line]
+            outcome = (row.get("data") or {}).get("metafieldsSet") or {}
+            # Top-level errors on a row mean the whole call failed
+            user_errors = [{"message": e.get("message", str(e)) if isinstance(e, dict) else str(e)}
+                           for e in row.get("errors") or []] or outcome.get("userErrors") or []
+            results = metafields_set_results(keys, user_errors)
+            result = {
+                "product_id": product_id,
+                "product": title,
+                "success_count": unchanged_count + sum(1 for r in results if r["ok"]),
+                "unchanged_count": unchanged_count,
+                "total_fields": unchanged_count + len(keys),
+                "errors": {r["key"]: r["error"] for r in results if not r["ok"]},
+            }
+            progress.record(result)
+            if on_result is not None:
+                await on_result(result)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    
+    print("✅ Bulk backfill complete!")
+    return {
+        "status": "complete",
+        "mode": "bulk",
+        "total_products": total,
+        "unchanged": unchanged,
+        "submitted": len(owners),
+        "failed": progress.failed - failed_before,
+        "errors": progress.errors[errors_before:],
+    }
+
+async def run_bulk(job: Job, workers: int = EXTRACT_WORKERS, mode: str = "pipeline", resume: bool = True,
+                   incremental: bool = False) -> Dict:
+    """One bulk run, reporting into job.progress and publishing each product's result."""
     print("🚀 Starting bulk processing...")
+    progress = job.progress
     
-    # Fetch products
-    products = await fetch_all_products()
-    print(f"📦 Found {len(products)} products")
+    if mode == "bulk":
+        try:
+            progress.total = await count_products(get_client())
+            return await run_bulk_backfill(workers=workers, progress=progress, on_result=job.publish)
+        except BulkOperationError as e:
+            print(f"❌ {e}")
+            return {"error": str(e)}
     
-    if not products:
-        return {"error": "No products found"}
+    if incremental and not BULK_STATE_DB:
+        return {"error": "Incremental runs need BULK_STATE_DB"}
+    
+    state = RunState(BULK_STATE_DB) if BULK_STATE_DB else None
+    try:
+        run = state.start(resume, incremental) if state is not None else None
+        if run and run["resumed"]:
+            print(f"⏯️ Resuming run {run['run_id']}")
+            counts = state.counts(run["run_id"])
+            progress.done_before = counts.get("written", 0) + counts.get("failed", 0)
+        
+        updated_at_min = None
+        if incremental and (high_water_mark := state.high_water_mark()) is not None:
+            updated_at_min = updated_since(high_water_mark)
+            print(f"🕒 Products updated since {updated_at_min}")
+        
+        progress.total = await count_products(get_client(), updated_at_min)
+        await run_pipeline(workers=workers, state=state, run=run, updated_at_min=updated_at_min,
+                           progress=progress, on_result=job.publish)
+        if state is None:
+            counts = {}
+        else:
+            counts = state.counts(run["run_id"])
+            # A page that failed to load leaves the run open at its cursor
+            if not state.finish(run["run_id"]):
+                print(f"⚠️ Run {run['run_id']} stopped early; start it again to resume")
+    finally:
+        if state is not None:
+            state.close()
     
-    # Process all products
-    results = []
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        for i, product in enumerate(products, 1):
-            print(f"🔄 Processing {i}/{len(products)}: {product.get('title', '')}")
-            result = await process_product(product, client)
-            results.append(result)
+    if not progress.processed and not counts and not incremental:
+        return {"error": "No products found"}
     
     print("✅ Processing complete!")
     
-    return {
+    response = {
         "status": "complete",
-        "total_products": len(products),
-        "results": results
+        "total_products": progress.processed,
     }
+    if run:
+        response.update(run_id=run["run_id"], resumed=run["resumed"], progress=counts)
+    return response
+
+def start_job(params: Dict) -> Job:
+    # workers comes from the query string; never fork more than the ceiling
+    params["workers"] = max(0, min(params["workers"], MAX_EXTRACT_WORKERS))
+    try:
+        return jobs.start(SHOPIFY_STORE_DOMAIN, params, lambda job: run_bulk(job, **params))
+    except JobConflict as e:
+        raise HTTPException(status_code=409, detail={"error": str(e), "job_id": e.job.id})
+
+@app.post("/jobs", status_code=202)
+async def create_job(workers: int = EXTRACT_WORKERS, mode: str = "pipeline", resume: bool = True,
+                     incremental: bool = False):
+    """Start a bulk run in the background; poll GET /jobs/{id} for progress.
+    
+    Takes the same options as /process. Only one job runs per store at a time.
+    """
+    job = start_job({"workers": workers, "mode": mode, "resume": resume, "incremental": incremental})
+    return {"job_id": job.id, "status": job.status}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job.report()
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """Cancel a running job; a checkpointed run can be resumed by the next job."""
+    job = jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    await asyncio.wait([job.task])
+    return job.report()
+
+@app.get("/process")
+async def process_all_products(workers: int = EXTRACT_WORKERS, mode: str = "pipeline", resume: bool = True,
+                               incremental: bool = False):
+    """Endpoint to trigger bulk processing.
+    
+    workers > 0 runs extraction in that many worker processes. mode=bulk
+    reads and writes through Shopify Bulk Operations instead of paging.
+    In pipeline mode an unfinished checkpointed run is resumed unless resume=false,
+    and incremental=true only processes products changed since the last completed run.
+    Runs as a job (see POST /jobs) and streams its results as NDJSON, one
+    {"type": "product"} line per product as it is written and a
+    {"type": "summary"} line at the end. The job keeps going if the client
+    disconnects.
+    """
+    job = start_job({"workers": workers, "mode": mode, "resume": resume, "incremental": incremental})
+    job.stream = ResultStream()
+    
+    async def body():
+        try:
+            async for record in job.stream:
+                yield json.dumps(record) + "\n"
+        finally:
+            job.stream.close()
+    
+    return StreamingResponse(body(), media_type="application/x-ndjson")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,221 @@
+# bulk_state.py - SQLite checkpoints so an interrupted bulk run can pick up where it stopped
+
+import json
+import sqlite3
+import time
+from typing import Dict, Iterator, List
+
+from catalog import ProductRecord
+from extraction import get_vocabulary, product_fingerprint
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,                 -- running, complete, abandoned
+    incremental INTEGER NOT NULL DEFAULT 0,
+    cursor TEXT,                          -- URL of the next page to fetch
+    fetch_done INTEGER NOT NULL DEFAULT 0,
+    started_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS products (
+    run_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    status TEXT NOT NULL,                 -- fetched, extracted, written, failed
+    title TEXT,
+    body_html TEXT,                       -- kept only until the product is extracted
+    fingerprint TEXT,                     -- title/body/vocabulary hash, see product_fingerprint
+    metafields TEXT,                      -- extracted values as JSON
+    error TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (run_id, product_id)
+);
+CREATE INDEX IF NOT EXISTS products_by_status ON products (run_id, status);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    product_id INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL             -- as of the last successful write
+);
+CREATE TABLE IF NOT EXISTS metafield_values (
+    product_id INTEGER PRIMARY KEY,
+    metafields TEXT NOT NULL              -- key -> value last written, as JSON
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Rows read back per query when replaying unfinished work
+REPLAY_BATCH_SIZE = 250
+
+
+class StoredValues:
+    """Metafield values last written per product, kept across restarts.
+
+    Same get/set as the in-memory cache.Cache, so write_changed_metafields
+    can plan against it instead of process memory.
+    """
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def get(self, product_id: int) -> Dict[str, str] | None:
+        row = self.db.execute(
+            "SELECT metafields FROM metafield_values WHERE product_id = ?", (product_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, product_id: int, values: Dict[str, str]):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO metafield_values (product_id, metafields) VALUES (?, ?)",
+                (product_id, json.dumps(values)),
+            )
+
+
+class RunState:
+    """Per-product progress of bulk runs, stored in one SQLite file.
+
+    A page's products are recorded together with the cursor of the page after
+    it, so after a crash every product is either in the table or still ahead
+    of the cursor. Resuming replays the unfinished rows, then keeps paging.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.written_values = StoredValues(self.db)
+
+    def close(self):
+        self.db.close()
+
+    def start(self, resume: bool = True, incremental: bool = False) -> Dict:
+        """Resume the latest unfinished run of the same kind, or open a new one."""
+        row = self.db.execute(
+            "SELECT id, cursor, fetch_done, incremental FROM runs WHERE status = 'running' ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        if row and resume and bool(row[3]) == incremental:
+            return {"run_id": row[0], "resumed": True, "cursor": row[1], "fetch_done": bool(row[2]),
+                    "incremental": incremental}
+
+        now = time.time()
+        with self.db:
+            self.db.execute("UPDATE runs SET status = 'abandoned', updated_at = ? WHERE status = 'running'", (now,))
+            run_id = self.db.execute(
+                "INSERT INTO runs (status, incremental, started_at, updated_at) VALUES ('running', ?, ?, ?)",
+                (incremental, now, now),
+            ).lastrowid
+        return {"run_id": run_id, "resumed": False, "cursor": None, "fetch_done": False,
+                "incremental": incremental}
+
+    def record_page(self, run_id: int, products: List[ProductRecord], next_url: str | None):
+        """Record a fetched page and move the cursor past it in one transaction."""
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO products (run_id, product_id, status, title, body_html, fingerprint, updated_at) "
+                "VALUES (?, ?, 'fetched', ?, ?, ?, ?)",
+                [(run_id, p.id, p.title, p.body_html, product_fingerprint(p.title, p.body_html), now)
+                 for p in products],
+            )
+            self.db.execute(
+                "UPDATE runs SET cursor = ?, fetch_done = ?, updated_at = ? WHERE id = ?",
+                (next_url, next_url is None, now, run_id),
+            )
+
+    def mark_extracted(self, run_id: int, items: List[Dict]):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "UPDATE products SET status = 'extracted', metafields = ?, body_html = NULL, updated_at = ? "
+                "WHERE run_id = ? AND product_id = ?",
+                [(json.dumps(item["metafields"]), now, run_id, item["product_id"]) for item in items],
+            )
+
+    def mark_written(self, run_id: int, product_id: int, errors: Dict | None = None):
+        status = "failed" if errors else "written"
+        with self.db:
+            self.db.execute(
+                "UPDATE products SET status = ?, error = ?, updated_at = ? WHERE run_id = ? AND product_id = ?",
+                (status, json.dumps(errors) if errors else None, time.time(), run_id, product_id),
+            )
+            if not errors:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO fingerprints SELECT product_id, fingerprint FROM products "
+                    "WHERE run_id = ? AND product_id = ?",
+                    (run_id, product_id),
+                )
+
+    def changed(self, products: List[ProductRecord]) -> List[ProductRecord]:
+        """Drop products whose title and body match their last successful write."""
+        if not products:
+            return products
+        ids = [p.id for p in products]
+        known = dict(self.db.execute(
+            f"SELECT product_id, fingerprint FROM fingerprints WHERE product_id IN ({','.join('?' * len(ids))})",
+            ids,
+        ).fetchall())
+        return [p for p in products if known.get(p.id) != product_fingerprint(p.title, p.body_html)]
+
+    def high_water_mark(self) -> float | None:
+        """Start time of the last completed run; everything updated before it was processed.
+
+        None once the vocabulary has changed since that run, since every
+        product may then extract differently.
+        """
+        rows = dict(self.db.execute(
+            "SELECT key, value FROM sync_state WHERE key IN ('high_water_mark', 'vocabulary_version')"
+        ).fetchall())
+        if "high_water_mark" not in rows or rows.get("vocabulary_version") != get_vocabulary().version:
+            return None
+        return float(rows["high_water_mark"])
+
+    def finish(self, run_id: int) -> bool:
+        """Close the run if every page was fetched and every product settled."""
+        with self.db:
+            cur = self.db.execute(
+                "UPDATE runs SET status = 'complete', updated_at = ? WHERE id = ? AND fetch_done = 1 "
+                "AND NOT EXISTS (SELECT 1 FROM products WHERE run_id = ? AND status IN ('fetched', 'extracted'))",
+                (time.time(), run_id, run_id),
+            )
+            if cur.rowcount == 1:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO sync_state SELECT 'high_water_mark', started_at FROM runs WHERE id = ?",
+                    (run_id,),
+                )
+                self.db.execute(
+                    "INSERT OR REPLACE INTO sync_state VALUES ('vocabulary_version', ?)", (get_vocabulary().version,),
+                )
+        return cur.rowcount == 1
+
+    def _replay(self, run_id: int, status: str, columns: str) -> Iterator[List[tuple]]:
+        last = -1
+        while True:
+            rows = self.db.execute(
+                f"SELECT product_id, {columns} FROM products WHERE run_id = ? AND status = ? AND product_id > ? "
+                "ORDER BY product_id LIMIT ?",
+                (run_id, status, last, REPLAY_BATCH_SIZE),
+            ).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield rows
+
+    def fetched_pages(self, run_id: int) -> Iterator[List[ProductRecord]]:
+        """Products fetched but not yet extracted, in page-sized batches."""
+        for rows in self._replay(run_id, "fetched", "title, body_html"):
+            yield [ProductRecord(pid, title, body) for pid, title, body in rows]
+
+    def extracted_items(self, run_id: int) -> Iterator[Dict]:
+        """Products extracted but not yet written."""
+        for rows in self._replay(run_id, "extracted", "title, metafields"):
+            for pid, title, metafields in rows:
+                yield {"product_id": pid, "title": title, "metafields": json.loads(metafields)}
+
+    def counts(self, run_id: int) -> Dict[str, int]:
+        rows = self.db.execute(
+            "SELECT status, COUNT(*) FROM products WHERE run_id = ? GROUP BY status", (run_id,)
+        ).fetchall()
+        return dict(rows)
@@ -0,0 +1,180 @@
+# cache.py - Bounded caches shared by the webhook app and the Shopify client
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Directory of a SQLite file through which the server's worker processes
+# share the caches made with shared_cache (set by gunicorn.conf.py); empty
+# keeps each process's caches in its own memory
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR", "")
+# Sets between sweeps of a shared cache's expired and surplus entries
+SHARED_PRUNE_INTERVAL = 100
+
+class Cache:
+    """Bounded least-recently-used mapping with optional expiry and counters.
+
+    Entries expire ttl seconds after they were set (never when ttl is None);
+    maxsize <= 0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None and item[0] is not None and item[0] < time.monotonic():
+            del self._data[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def add(self, key, value) -> bool:
+        """Set key unless it is already there; True if it was set."""
+        if self.get(key) is not None:
+            return False
+        self.set(key, value)
+        return True
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data), "maxsize": self.maxsize,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+        }
+
+class SharedCache:
+    """Cache's get/set/add/pop, kept in a SQLite file every process can open.
+
+    Entries are evicted oldest-set first. The connection is opened lazily
+    and again after a fork, so the object can be built before gunicorn forks
+    its workers. Keys and values must be JSON-serializable.
+    """
+
+    def __init__(self, path: str, name: str, maxsize: int, ttl: float | None = None):
+        self.path = path
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._sets = 0
+        self._pid = None
+        self._db: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS cache_entries (
+                    cache TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL,
+                    PRIMARY KEY (cache, key)
+                )""")
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def _expires_at(self) -> float | None:
+        # Wall-clock time, which (unlike monotonic time) every process agrees on
+        return time.time() + self.ttl if self.ttl is not None else None
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT value FROM cache_entries WHERE cache = ? AND key = ?"
+                " AND (expires_at IS NULL OR expires_at >= ?)",
+                (self.name, json.dumps(key), time.time()),
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            db = self._connect()
+            # REPLACE deletes the old row, so the entry moves to the newest rowid
+            db.execute("INSERT OR REPLACE INTO cache_entries (cache, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                       (self.name, json.dumps(key), json.dumps(value), self._expires_at()))
+            self._after_set(db)
+
+    def add(self, key, value) -> bool:
+        """Set key unless another process (or this one) already has; True if it was set."""
+        if self.maxsize <= 0:
+            return True
+        with self._lock:
+            db = self._connect()
+            added = db.execute(
+                "INSERT INTO cache_entries (cache, key, value, expires_at) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (cache, key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at"
+                " WHERE cache_entries.expires_at < ?",
+                (self.name, json.dumps(key), json.dumps(value), self._expires_at(), time.time()),
+            ).rowcount == 1
+            if added:
+                self._after_set(db)
+        return added
+
+    def pop(self, key):
+        with self._lock:
+            self._connect().execute("DELETE FROM cache_entries WHERE cache = ? AND key = ?",
+                                    (self.name, json.dumps(key)))
+
+    def _after_set(self, db: sqlite3.Connection):
+        self._sets += 1
+        if self._sets % SHARED_PRUNE_INTERVAL:
+            return
+        self.evictions += db.execute(
+            "DELETE FROM cache_entries WHERE cache = ? AND (expires_at < ? OR rowid <= ("
+            "SELECT rowid FROM cache_entries WHERE cache = ? ORDER BY rowid DESC LIMIT 1 OFFSET ?))",
+            (self.name, time.time(), self.name, self.maxsize),
+        ).rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE cache = ?", (self.name,)
+            ).fetchone()[0]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self), "maxsize": self.maxsize,
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+        }
+
+def shared_cache(name: str, maxsize: int, ttl: float | None = None) -> Cache | SharedCache:
+    """A cache every worker process sees when SHARED_STATE_DIR is set, else an in-memory one."""
+    if SHARED_STATE_DIR:
+        return SharedCache(os.path.join(SHARED_STATE_DIR, "state.sqlite3"), name, maxsize, ttl)
+    return Cache(maxsize, ttl)
@@ -0,0 +1,31 @@
+# catalog.py - Compact product records for bulk runs
+
+# The product fields bulk runs read; catalog listings ask Shopify for only these
+PRODUCT_FIELDS = ("id", "title", "body_html", "updated_at")
+
+class ProductRecord:
+    """A product as bulk runs hold it: the fields extraction reads, in slots.
+
+    Listings are requested with only PRODUCT_FIELDS, so variants, images and
+    options are never downloaded. current_metafields is only set for products
+    read from a bulk export, which carries them.
+    """
+
+    __slots__ = ("id", "title", "body_html", "updated_at", "current_metafields")
+
+    def __init__(self, id: int, title: str = "", body_html: str = "", updated_at: str | None = None,
+                 current_metafields: dict | None = None):
+        self.id = id
+        self.title = title
+        self.body_html = body_html
+        self.updated_at = updated_at
+        self.current_metafields = current_metafields
+
+    @classmethod
+    def from_json(cls, product: dict) -> "ProductRecord":
+        """Record for a product from the REST API."""
+        return cls(product["id"], product.get("title") or "", product.get("body_html") or "",
+                   product.get("updated_at"))
+
+    def __repr__(self) -> str:
+        return f"ProductRecord(id={self.id!r}, title={self.title!r})"
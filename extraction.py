@@ -0,0 +1,474 @@
+# extraction.py - Vocabularies and metafield extraction, shared by the webhook and the bulk processor
+
+import hashlib
+import json
+import logging
+import os
+import marshal
+import re
+import stat
+import tempfile
+import threading
+
+import html_text
+from normalize import NormalizedText, normalize, normalize_vocabulary
+from metrics import STAGE_SECONDS
+
+# DEBUG logs every extraction decision
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+logger = logging.getLogger("lsf.extract")
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(logging.StreamHandler())
+
+# Directory holding the vocabulary JSON files
+VOCABULARY_DIR = os.environ.get(
+    "VOCABULARY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vocabularies"),
+)
+# Compiled matchers are cached here, keyed by a hash of the vocabulary files
+# (empty disables the cache and compiles on every start). The directory must
+# be private to this user; any other is ignored.
+VOCABULARY_CACHE_DIR = os.environ.get(
+    "VOCABULARY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "lsf-vocabulary"),
+)
+# Bump when the Vocabulary layout or normalization changes, so stale artifacts are not loaded
+ARTIFACT_FORMAT = 1
+
+# Field -> vocabulary file. Each file is a JSON object of named groups (lists
+# of display names, or objects mapping phrase -> value) read in file order.
+VOCABULARY_FILES = {
+    "designer_synonym": "designer_synonyms.json",
+    "designer": "designers.json",
+    "condition": "conditions.json",
+    "color": "colors.json",
+    "product_type": "product_types.json",
+    "material": "materials.json",
+}
+
+# Fields whose phrases containing & - / . only need non-word characters around them
+_LOOKAROUND_FIELDS = ("designer_synonym", "designer")
+
+# Words, or single punctuation characters; whitespace only separates tokens
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_WORD_RE = re.compile(r"\w")
+
+# What the character just outside a phrase must be
+_ANY, _WORD, _NON_WORD = 0, 1, 2
+
+def _has_special_chars(phrase: str) -> bool:
+    # For patterns with & or other special chars, use lookaround instead of \b
+    return any(c in phrase for c in ['&', '-', '/', '.'])
+
+def _edge_rule(ch: str, lookaround: bool) -> int:
+    """Rule for the text next to a phrase that starts or ends with ch.
+
+    Next to a word character the token boundary already holds. Next to
+    punctuation, \\b wants a word character on the other side and the
+    lookaround form wants anything but one.
+    """
+    if _WORD_RE.match(ch):
+        return _ANY
+    return _NON_WORD if lookaround else _WORD
+
+def _edge_ok(rule: int, text: str, i: int) -> bool:
+    if rule == _ANY:
+        return True
+    is_word = 0 <= i < len(text) and _WORD_RE.match(text, i) is not None
+    return is_word == (rule == _WORD)
+
+def _flatten(groups: dict):
+    """One vocabulary file's groups merged in order."""
+    if all(isinstance(entries, list) for entries in groups.values()):
+        return [entry for entries in groups.values() for entry in entries]
+    merged = {}
+    for entries in groups.values():
+        merged.update(entries)
+    return merged
+
+def _read_files(directory: str) -> dict[str, bytes]:
+    files = {}
+    for name in VOCABULARY_FILES.values():
+        with open(os.path.join(directory, name), "rb") as f:
+            files[name] = f.read()
+    return files
+
+def _version(files: dict[str, bytes]) -> str:
+    digest = hashlib.sha1(f"format {ARTIFACT_FORMAT}\0".encode())
+    for name in sorted(files):
+        digest.update(name.encode() + b"\0" + files[name] + b"\0")
+    return digest.hexdigest()[:12]
+
+def _parse(files: dict[str, bytes]) -> dict:
+    return {field: _flatten(json.loads(files[name])) for field, name in VOCABULARY_FILES.items()}
+
+def vocabulary_version(directory: str = VOCABULARY_DIR) -> str:
+    """Hash of the vocabulary files and artifact format."""
+    return _version(_read_files(directory))
+
+def load_sources(directory: str = VOCABULARY_DIR) -> dict:
+    """Field -> vocabulary as listed in its file (list of names or dict phrase -> value)."""
+    return _parse(_read_files(directory))
+
+class Vocabulary:
+    """All vocabularies, normalized and indexed for one scan of the text.
+
+    ``vocabularies[field]`` maps normalized phrase -> value and
+    ``phrases[field]`` lists the phrases in precedence order (longest first);
+    scan() returns indices into those lists. Instances hold only plain data
+    (see _ARTIFACT_FIELDS), which is what the on-disk artifact stores.
+
+    The index keys a phrase on its tokens joined the way they appear in text:
+    one space where whitespace separates them, nothing where they touch
+    ("d&g", "t-shirt"). Scanning tokenizes the text once and, from every
+    token, extends the n-gram only while it is still the prefix of some
+    phrase, so the cost follows text length rather than vocabulary size.
+    """
+
+    def __init__(self, sources: dict, version: str):
+        self.version = version
+        self.vocabularies: dict[str, dict] = {}
+        self.phrases: dict[str, list[str]] = {}
+        self._entries: dict[str, list[tuple[str, int, int, int]]] = {}
+        self._prefixes: set[str] = set()
+        for field, entries in sources.items():
+            # Spellings that normalize alike ("celine"/"céline") collapse into one entry
+            vocabulary = normalize_vocabulary(entries)
+            phrases = sorted(vocabulary, key=len, reverse=True)
+            self.vocabularies[field] = vocabulary
+            self.phrases[field] = phrases
+            for i, phrase in enumerate(phrases):
+                # Text and phrases are normalized alike, so an equal key is an
+                # exact match and only the characters around it need checking
+                lookaround = field in _LOOKAROUND_FIELDS and _has_special_chars(phrase)
+                self._entries.setdefault(phrase, []).append(
+                    (field, i, _edge_rule(phrase[0], lookaround), _edge_rule(phrase[-1], lookaround))
+                )
+                for m in list(_TOKEN_RE.finditer(phrase))[:-1]:
+                    self._prefixes.add(phrase[:m.end()])
+
+    def scan(self, text: str) -> dict[str, list[int]]:
+        """Indices of every phrase found in normalized text, per field, in precedence order."""
+        found: dict[str, set[int]] = {field: set() for field in self.phrases}
+        tokens = [m.span() for m in _TOKEN_RE.finditer(text)]
+        for i, (start, end) in enumerate(tokens):
+            key = text[start:end]
+            j = i + 1
+            while True:
+                for field, k, before, after in self._entries.get(key, ()):
+                    if _edge_ok(before, text, start - 1) and _edge_ok(after, text, start + len(key)):
+                        found[field].add(k)
+                if j == len(tokens) or key not in self._prefixes:
+                    break
+                next_start, next_end = tokens[j]
+                sep = " " if next_start > tokens[j - 1][1] else ""
+                key += sep + text[next_start:next_end]
+                j += 1
+        return {field: sorted(indices) for field, indices in found.items()}
+
+# Vocabulary attributes stored in the artifact, and the type each must load as
+_ARTIFACT_FIELDS = {"version": str, "vocabularies": dict, "phrases": dict, "_entries": dict, "_prefixes": set}
+
+def _private_dir(path: str) -> bool:
+    """Create path if needed; True only if it is a directory owned by and private to this user."""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        return False
+    # Ours and writable by no one else (e.g. made under the old default umask): close it up
+    if st.st_mode & 0o077:
+        os.chmod(path, 0o700)
+    return True
+
+def _write_artifact(vocabulary: Vocabulary, path: str):
+    # marshal rather than pickle: loading it builds plain data and never runs code.
+    # Written to a temporary name and renamed, so a concurrent start never reads half a file
+    data = marshal.dumps({name: getattr(vocabulary, name) for name in _ARTIFACT_FIELDS})
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _read_artifact(path: str, version: str) -> Vocabulary | None:
+    with open(path, "rb") as f:
+        # loads on the whole file; load() on a file object is ~20x slower
+        state = marshal.loads(f.read())
+    if not (isinstance(state, dict) and state.keys() == _ARTIFACT_FIELDS.keys()
+            and all(isinstance(state[name], kind) for name, kind in _ARTIFACT_FIELDS.items())
+            and state["version"] == version):
+        return None
+    vocabulary = Vocabulary.__new__(Vocabulary)
+    vocabulary.__dict__.update(state)
+    return vocabulary
+
+def load_vocabulary(directory: str = VOCABULARY_DIR, cache_dir: str = VOCABULARY_CACHE_DIR) -> Vocabulary:
+    """The compiled vocabulary for directory, from the artifact cache when it has one."""
+    # Hashed and parsed from the same bytes, so a file edited meanwhile can't mislabel the artifact
+    files = _read_files(directory)
+    version = _version(files)
+    path = None
+    if cache_dir:
+        try:
+            if _private_dir(cache_dir):
+                path = os.path.join(cache_dir, f"vocabulary-{version}.marshal{marshal.version}")
+            else:
+                print(f"⚠️ Not caching vocabulary artifacts in {cache_dir}: not a private directory of this user")
+        except OSError as e:
+            print(f"⚠️ Could not cache vocabulary artifact in {cache_dir}: {e!r}")
+    if path and os.path.exists(path):
+        try:
+            vocabulary = _read_artifact(path, version)
+            if vocabulary is not None:
+                return vocabulary
+        except Exception as e:
+            print(f"⚠️ Ignoring unreadable vocabulary artifact {path}: {e!r}")
+
+    vocabulary = Vocabulary(_parse(files), version)
+    if path:
+        try:
+            _write_artifact(vocabulary, path)
+        except OSError as e:
+            print(f"⚠️ Could not cache vocabulary artifact in {cache_dir}: {e!r}")
+    return vocabulary
+
+_vocabulary = load_vocabulary()
+_reload_lock = threading.Lock()
+
+def get_vocabulary() -> Vocabulary:
+    """The vocabulary extraction currently uses.
+
+    Take it once per product and pass it along: a reload swaps in a new
+    object but never changes one already handed out.
+    """
+    return _vocabulary
+
+def reload_vocabulary(directory: str = VOCABULARY_DIR) -> tuple[Vocabulary, Vocabulary]:
+    """Compile the vocabulary files and swap them in; returns (previous, current).
+
+    Compilation happens before the swap, so extraction keeps using the
+    previous vocabulary until the new one is ready. Unchanged files are not
+    recompiled. Raises (leaving the current vocabulary in place) when a file
+    is missing or malformed.
+    """
+    global _vocabulary
+    with _reload_lock:
+        previous = _vocabulary
+        if vocabulary_version(directory) == previous.version:
+            return previous, previous
+        _vocabulary = load_vocabulary(directory)
+        return previous, _vocabulary
+
+def product_fingerprint(title: str, body_html: str, version: str | None = None) -> str:
+    """Hash of the fields extraction reads and the vocabulary version (default:
+    current); equal hashes give equal metafields.
+
+    The webhook's echo filter and incremental bulk runs both compare these,
+    so they must agree on the formula.
+    """
+    version = version or get_vocabulary().version
+    return hashlib.sha1(f"{version}\0{title}\0{body_html}".encode("utf-8")).hexdigest()
+
+@STAGE_SECONDS.timed(stage="extract_designer")
+def extract_designer(text: str | NormalizedText, hits: dict[str, list[int]] | None = None,
+                     vocab: Vocabulary | None = None) -> str:
+    vocab = vocab or _vocabulary
+    t = normalize(text).text
+    logger.debug("Searching for designer in: %.100s...", t)
+    if hits is None:
+        hits = vocab.scan(t)
+
+    # Check synonyms first (longest to shortest to match most specific first)
+    if hits["designer_synonym"]:
+        syn = vocab.phrases["designer_synonym"][hits["designer_synonym"][0]]
+        canonical = vocab.vocabularies["designer_synonym"][syn]
+        logger.debug("Found designer via synonym '%s' -> %s", syn, canonical)
+        return canonical
+
+    # Check main designer list
+    if hits["designer"]:
+        designer = vocab.vocabularies["designer"][vocab.phrases["designer"][hits["designer"][0]]]
+        logger.debug("Found designer in main list: %s", designer)
+        return designer
+
+    logger.debug("No designer found, returning 'unbranded'")
+    return "unbranded"
+
+@STAGE_SECONDS.timed(stage="extract_condition")
+def extract_condition(text: str | NormalizedText, hits: dict[str, list[int]] | None = None,
+                      vocab: Vocabulary | None = None) -> str | None:
+    vocab = vocab or _vocabulary
+    t = normalize(text).text
+    logger.debug("Searching for condition in: %.100s...", t)
+    if hits is None:
+        hits = vocab.scan(t)
+
+    # Phrases are ordered by length (longest first) to match most specific phrases first
+    if hits["condition"]:
+        phrase = vocab.phrases["condition"][hits["condition"][0]]
+        condition = vocab.vocabularies["condition"][phrase]
+        logger.debug("Found condition via phrase '%s' -> %s", phrase, condition)
+        return condition
+
+    logger.debug("No condition found")
+    return None
+
+@STAGE_SECONDS.timed(stage="extract_colors")
+def extract_colors(text: str | NormalizedText, hits: dict[str, list[int]] | None = None,
+                   vocab: Vocabulary | None = None) -> list[str]:
+    vocab = vocab or _vocabulary
+    if hits is None:
+        hits = vocab.scan(normalize(text).text)
+
+    # Ordered by length (longest first) to match compound colors before simple ones
+    colors, phrases = vocab.vocabularies["color"], vocab.phrases["color"]
+    found = [colors[phrases[i]] for i in hits["color"]]
+    return list(dict.fromkeys(found))
+
+@STAGE_SECONDS.timed(stage="extract_type")
+def extract_type(text: str | NormalizedText, hits: dict[str, list[int]] | None = None,
+                 vocab: Vocabulary | None = None) -> str | None:
+    vocab = vocab or _vocabulary
+    t = normalize(text).text
+    logger.debug("Searching for product type in: %.100s...", t)
+    if hits is None:
+        hits = vocab.scan(t)
+
+    # Ordered by length (longest first) to match most specific types first
+    if hits["product_type"]:
+        phrase = vocab.phrases["product_type"][hits["product_type"][0]]
+        ptype = vocab.vocabularies["product_type"][phrase]
+        logger.debug("Found product type via phrase '%s' -> %s", phrase, ptype)
+        return ptype
+
+    logger.debug("No product type found")
+    return None
+
+@STAGE_SECONDS.timed(stage="extract_era")
+def extract_era(text: str | NormalizedText) -> str | None:
+    t = normalize(text).text
+    # 1960s variations
+    if any(x in t for x in ["1960s", "60s", "sixties", "'60s", "1960's", "60's",
+                             "mod era", "youthquake", "space age", "vintage 60s", 
+                             "twiggy", "mod style", "swinging sixties"]):
+        return "1960s"
+    # 1970s variations
+    if any(x in t for x in ["1970s", "70s", "seventies", "'70s", "1970's", "70's",
+                             "disco era", "boho era", "hippie era", "studio 54", 
+                             "vintage 70s", "disco", "bohemian 70s"]):
+        return "1970s"
+    # 1980s variations
+    if any(x in t for x in ["1980s", "80s", "eighties", "'80s", "1980's", "80's",
+                             "power dressing", "shoulder pad era", "vintage 80s", 
+                             "new wave", "power suit", "80s glam"]):
+        return "1980s"
+    # 1990s variations
+    if any(x in t for x in ["1990s", "90s", "nineties", "'90s", "1990's", "90's",
+                             "grunge", "minimalist era", "supermodel era", 
+                             "vintage 90s", "90s minimalism"]):
+        return "1990s"
+    # 2000s variations
+    if any(x in t for x in ["y2k", "2000s", "00s", "'00s", "early 2000s", "aughts",
+                             "mcbling", "millennium fashion", "paris hilton era",
+                             "2000's", "00's", "y2k aesthetic"]):
+        return "2000s / Y2K"
+    # 2010s variations
+    if any(x in t for x in ["2010s", "10s", "'10s", "early 2010s", "2010's",
+                             "normcore", "athleisure", "streetwear era"]):
+        return "2010s"
+    # Spring/Summer variations
+    if any(x in t for x in ["spring/summer", "spring summer", "s/s", "ss", 
+                             "resort", "cruise", "ss20", "ss21", "ss22", "ss23", "ss24"]):
+        return "Spring/Summer"
+    # Fall/Winter variations
+    if any(x in t for x in ["fall/winter", "fall winter", "f/w", "fw", 
+                             "autumn/winter", "aw", "fw20", "fw21", "fw22", "fw23", "fw24"]):
+        return "Fall/Winter"
+    return None
+
+@STAGE_SECONDS.timed(stage="extract_materials")
+def extract_materials(text: str | NormalizedText, hits: dict[str, list[int]] | None = None,
+                      vocab: Vocabulary | None = None) -> list[str]:
+    vocab = vocab or _vocabulary
+    if hits is None:
+        hits = vocab.scan(normalize(text).text)
+
+    # Ordered by length (longest first) to match compound materials before simple ones
+    materials, phrases = vocab.vocabularies["material"], vocab.phrases["material"]
+    found = [materials[phrases[i]] for i in hits["material"]]
+    return list(dict.fromkeys(found))
+
+def extract_metafields(text: str | NormalizedText, hits: dict[str, list[int]] | None = None,
+                       vocab: Vocabulary | None = None) -> list[dict]:
+    """Metafields for product text; hits from vocab.scan() are reused when given."""
+    vocab = vocab or _vocabulary
+    if hits is None:
+        text = normalize(text)
+        with STAGE_SECONDS.time(stage="phrase_scan"):
+            hits = vocab.scan(text.text)
+
+    designer = extract_designer(text, hits, vocab)
+    condition = extract_condition(text, hits, vocab)
+    colors = extract_colors(text, hits, vocab)
+    ptype = extract_type(text, hits, vocab)
+    era = extract_era(text)
+    materials = extract_materials(text, hits, vocab)
+
+    metafields: list[dict] = []
+
+    def add_field(key: str, value, type_: str = "single_line_text_field"):
+        if value is None:
+            return
+        metafields.append({
+            "namespace": "custom",
+            "key": key,
+            "type": type_,
+            "value": str(value),
+        })
+
+    add_field("designer", designer)
+    add_field("condition_rating", condition)
+    if colors:
+        add_field("color", colors[0])
+    add_field("product_type", ptype)
+    add_field("season", era)
+    if materials:
+        add_field("material", ", ".join(materials))
+
+    return metafields
+
+def _as_text(value) -> str:
+    # Missing fields are empty; anything else is read as its string form
+    return "" if value is None else str(value)
+
+def product_text(title, body_html) -> str:
+    """Title and body HTML as extraction reads them (see html_text.product_text).
+
+    None counts as empty and any other non-string is converted with str(),
+    so malformed product JSON can't crash extraction.
+    """
+    with STAGE_SECONDS.time(stage="html_strip"):
+        return html_text.product_text(_as_text(title), _as_text(body_html))
+
+def extract_product(product_id, title, body_html, vocab: Vocabulary | None = None) -> dict:
+    """Metafields for one product from its title and body HTML."""
+    vocab = vocab or _vocabulary
+    text = product_text(title, body_html)
+    with STAGE_SECONDS.time(stage="normalize"):
+        norm = normalize(text)
+    return {
+        "product_id": product_id,
+        "title": _as_text(title),
+        "metafields": extract_metafields(norm, None, vocab),
+        "vocabulary_version": vocab.version,
+    }
+
+def extract_batch(products) -> list[dict]:
+    """Extract products given as (id, title, body_html), in input order.
+
+    The whole batch uses the vocabulary current when it starts. Nothing is
+    cached or written anywhere.
+    """
+    vocab = _vocabulary
+    return [extract_product(product_id, title, body_html, vocab) for product_id, title, body_html in products]
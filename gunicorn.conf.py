@@ -0,0 +1,59 @@
+# gunicorn.conf.py - Multi-process serving for the webhook app
+#
+#   gunicorn main:app -c gunicorn.conf.py
+#
+# The app (and with it the compiled vocabulary) is imported once in the
+# master and forked into the workers, which share those pages copy-on-write.
+
+import gc
+import os
+import shutil
+import tempfile
+
+# Worker processes; one per core is a good start
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn_worker.UvicornWorker"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+preload_app = True
+# Seconds a worker gets to drain its webhook queue on shutdown (WEBHOOK_DRAIN_TIMEOUT plus slack)
+graceful_timeout = int(float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "20"))) + 10
+
+# Per-worker concurrency is the app's own: WEBHOOK_WORKERS jobs at once,
+# WEBHOOK_QUEUE_SIZE queued. Each worker keeps its own queue and extraction
+# cache.
+
+# Workers publish metrics here so any of them can answer /metrics for all
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"lsf-metrics-{os.getpid()}"))
+# Redeliveries and the echoes of our own writes can land on any worker, so
+# the webhook dedup, echo fingerprints and last-written values live here
+os.environ.setdefault("SHARED_STATE_DIR", os.path.join(tempfile.gettempdir(), f"lsf-state-{os.getpid()}"))
+# An admin reload only reaches the worker that served it; the watcher brings
+# the others along (they load the artifact it cached rather than recompiling)
+os.environ.setdefault("VOCABULARY_WATCH_INTERVAL", "5")
+
+def on_starting(server):
+    for name in ("METRICS_DIR", "SHARED_STATE_DIR"):
+        shutil.rmtree(os.environ[name], ignore_errors=True)
+        os.makedirs(os.environ[name])
+
+def when_ready(server):
+    # Objects built at import never change; keep the collector from touching
+    # (and so copying) their pages in every worker
+    gc.collect()
+    gc.freeze()
+
+def post_fork(server, worker):
+    import metrics
+    metrics.start_multiprocess()
+
+def worker_exit(server, worker):
+    import metrics
+    metrics.write_snapshot()
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
+
+def on_exit(server):
+    for name in ("METRICS_DIR", "SHARED_STATE_DIR"):
+        shutil.rmtree(os.environ[name], ignore_errors=True)
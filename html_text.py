@@ -0,0 +1,73 @@
+# html_text.py - Product body HTML to plain text, shared by the webhook and the bulk processor
+
+import os
+import re
+from html import unescape
+
+# Upper bound on the text extraction sees per product; the title is always kept
+# whole and the body fills what is left
+MAX_TEXT_CHARS = int(os.environ.get("MAX_TEXT_CHARS", "10000"))
+
+# Elements whose contents are never product copy
+SKIP_TAGS = frozenset({
+    "script", "style", "noscript", "template", "head", "title", "svg", "math", "iframe", "object",
+})
+
+# "<" only opens a tag before a letter, "/", "!" or "?"; otherwise it is text ("size < 5")
+_TAG_START_RE = re.compile(r"<[A-Za-z/!?]")
+_TAG_NAME_RE = re.compile(r"[A-Za-z][\w:-]*")
+_CLOSE_TAG_RES = {tag: re.compile(rf"</{tag}\b[^>]*>", re.IGNORECASE) for tag in SKIP_TAGS}
+
+def html_to_text(html: str, limit: int = MAX_TEXT_CHARS) -> str:
+    """Visible text of an HTML fragment, at most limit characters.
+
+    Entities are decoded, script/style and similar elements dropped, and
+    whitespace collapsed; every tag is a word boundary. The fragment is read
+    left to right in one pass that stops once limit characters are collected,
+    so a pasted 500 KB body costs no more downstream than a short one.
+    """
+    parts = []
+    size = 0
+    pos, n = 0, len(html)
+    while pos < n and size <= limit:
+        tag = _TAG_START_RE.search(html, pos)
+        end = tag.start() if tag else n
+        if end > pos:
+            chunk = html[pos:end]
+            if "&" in chunk:
+                chunk = unescape(chunk)
+            chunk = " ".join(chunk.split())
+            if chunk:
+                parts.append(chunk)
+                size += len(chunk) + 1
+        if tag is None:
+            break
+
+        if html.startswith("<!--", end):
+            close = html.find("-->", end + 4)
+            pos = close + 3 if close >= 0 else n
+            continue
+        gt = html.find(">", end)
+        if gt < 0:
+            break
+        name = _TAG_NAME_RE.match(html, end + 1)
+        close_re = _CLOSE_TAG_RES.get(name.group().lower()) if name else None
+        if close_re is not None:
+            # Jump past the matching close tag; an unclosed one hides the rest
+            close = close_re.search(html, gt)
+            if close is None:
+                break
+            gt = close.end() - 1
+        pos = gt + 1
+
+    text = " ".join(parts)
+    if len(text) > limit:
+        # Cut at a word boundary so no truncated word can match a shorter phrase
+        cut = text.rfind(" ", 0, limit + 1)
+        text = text[:cut] if cut > 0 else ""
+    return text
+
+def product_text(title: str, body_html: str, max_chars: int = MAX_TEXT_CHARS) -> str:
+    """Title and body text as extraction reads them; only the body is cut to fit max_chars."""
+    body_text = html_to_text(body_html, max(0, max_chars - len(title) - 1))
+    return f"{title}\n{body_text}"
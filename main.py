@@ -3,16 +3,124 @@ import hmac
 import hashlib
 import base64
 import json
-import re
-
-from fastapi import FastAPI, Request, HTTPException
-import httpx
-
-app = FastAPI()
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+
+from cache import Cache, shared_cache
+from extraction import (
+    extract_batch, extract_metafields, get_vocabulary, product_fingerprint, product_text, reload_vocabulary,
+    vocabulary_version,
+)
+from normalize import normalize
+from metrics import CONTENT_TYPE, IN_FLIGHT, STAGE_SECONDS, VOCABULARY_RELOADS, render as render_metrics
+from shopify_client import get_client, lifespan, write_changed_metafields
 
 SHOPIFY_SECRET = os.environ.get("SHOPIFY_SECRET", "")
 SHOPIFY_API_TOKEN = os.environ.get("SHOPIFY_API_TOKEN", "")
 SHOPIFY_STORE_DOMAIN = os.environ.get("SHOPIFY_STORE_DOMAIN", "")
+# Bearer token for the /admin endpoints (empty disables them)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# Bearer token for POST /extract (defaults to ADMIN_TOKEN; empty disables it),
+# and the largest request it takes, in bytes and in products
+EXTRACT_TOKEN = os.environ.get("EXTRACT_TOKEN", ADMIN_TOKEN)
+EXTRACT_MAX_BYTES = int(os.environ.get("EXTRACT_MAX_BYTES", str(10 * 1024 * 1024)))
+EXTRACT_MAX_PRODUCTS = int(os.environ.get("EXTRACT_MAX_PRODUCTS", "1000"))
+
+# Webhook jobs are queued and handled by background workers. When the queue
+# is full, "reject" answers 503 so Shopify redelivers later and "wait" holds
+# the request until there is room.
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_QUEUE_FULL = os.environ.get("WEBHOOK_QUEUE_FULL", "reject")
+# Seconds to let queued jobs finish at shutdown
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "20"))
+# Remember delivered X-Shopify-Webhook-Id values to drop redeliveries
+WEBHOOK_DEDUP_TTL = float(os.environ.get("WEBHOOK_DEDUP_TTL", "3600"))
+WEBHOOK_DEDUP_SIZE = int(os.environ.get("WEBHOOK_DEDUP_SIZE", "10000"))
+# Remember the title/body (and vocabulary) we last wrote metafields for, per
+# product, to drop the products/update webhooks our own writes trigger
+ECHO_TTL = float(os.environ.get("ECHO_TTL", "86400"))
+ECHO_CACHE_SIZE = int(os.environ.get("ECHO_CACHE_SIZE", "100000"))
+# Seconds between checks of the vocabulary files for changes (0 = reload
+# only through POST /admin/vocabulary/reload)
+VOCABULARY_WATCH_INTERVAL = float(os.environ.get("VOCABULARY_WATCH_INTERVAL", "0"))
+
+webhook_queue: asyncio.Queue | None = None
+webhook_stats = {
+    "processed": 0, "failed": 0, "rejected": 0, "duplicates": 0, "echoes": 0, "lag_seconds": 0.0,
+}
+
+seen_webhooks = shared_cache("seen_webhooks", WEBHOOK_DEDUP_SIZE, WEBHOOK_DEDUP_TTL)
+written_fingerprints = shared_cache("written_fingerprints", ECHO_CACHE_SIZE, ECHO_TTL)
+
+async def apply_vocabulary_reload() -> dict:
+    """Recompile the vocabulary files in a thread and swap the result in.
+
+    Requests already extracting keep the vocabulary they started with.
+    """
+    try:
+        previous, current = await run_in_threadpool(reload_vocabulary)
+    except Exception:
+        VOCABULARY_RELOADS.inc(status="failed")
+        raise
+    status = "unchanged" if current is previous else "reloaded"
+    VOCABULARY_RELOADS.inc(status=status)
+    if status == "reloaded":
+        print(f"📚 Vocabulary {previous.version} -> {current.version}")
+    return {"status": status, "version": current.version, "previous_version": previous.version}
+
+async def vocabulary_watcher():
+    failed_version = None
+    while True:
+        await asyncio.sleep(VOCABULARY_WATCH_INTERVAL)
+        try:
+            version = await run_in_threadpool(vocabulary_version)
+        except OSError as e:
+            print(f"⚠️ Could not read vocabulary files: {e!r}")
+            continue
+        # A file that failed to load is retried only once it changes again
+        if version in (get_vocabulary().version, failed_version):
+            continue
+        try:
+            await apply_vocabulary_reload()
+            failed_version = None
+        except Exception as e:
+            failed_version = version
+            print(f"❌ Vocabulary reload failed, keeping {get_vocabulary().version}: {e!r}")
+
+@asynccontextmanager
+async def app_lifespan(app):
+    """Open the shared HTTP client and run the webhook workers."""
+    global webhook_queue
+    async with lifespan(app):
+        webhook_queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        workers = [asyncio.create_task(webhook_worker()) for _ in range(WEBHOOK_WORKERS)]
+        if VOCABULARY_WATCH_INTERVAL > 0:
+            workers.append(asyncio.create_task(vocabulary_watcher()))
+        try:
+            yield
+        finally:
+            try:
+                await asyncio.wait_for(webhook_queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"Shutting down with {webhook_queue.qsize()} webhook jobs still queued")
+            for worker in workers:
+                worker.cancel()
+            webhook_queue = None
+
+app = FastAPI(lifespan=app_lifespan)
+
+def verify_bearer_token(authorization: str, token: str) -> bool:
+    if not token:
+        return False
+    return hmac.compare_digest(authorization.encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+
+def verify_admin_token(authorization: str) -> bool:
+    return verify_bearer_token(authorization, ADMIN_TOKEN)
 
 def verify_shopify_hmac(request_body: bytes, hmac_header: str) -> bool:
     if not SHOPIFY_SECRET:
@@ -21,907 +129,221 @@ def verify_shopify_hmac(request_body: bytes, hmac_header: str) -> bool:
     calculated_hmac = base64.b64encode(digest).decode()
     return hmac.compare_digest(calculated_hmac, hmac_header)
 
-# Comprehensive designer list (from your old code)
-DESIGNERS = [
-    "Yves Saint Laurent", "Christian Dior", "Cristóbal Balenciaga", "Pierre Cardin",
-    "André Courrèges", "Hubert de Givenchy", "Emanuel Ungaro", "Balmain", "Lanvin",
-    "Mary Quant", "Ossie Clark", "Biba", "Barbara Hulanicki", "Rudi Gernreich",
-    "Paco Rabanne", "Bonnie Cashin", "Geoffrey Beene", "Bill Blass", "Norman Norell",
-    "Anne Klein", "Pauline Trigère", "Halston", "Donald Brooks", "Diane von Fürstenberg",
-    "Calvin Klein", "Ralph Lauren", "Perry Ellis", "Stephen Burrows", "Karl Lagerfeld",
-    "Missoni", "Jean Muir", "Sonia Rykiel", "Kenzo Takada", "Issey Miyake",
-    "Kansai Yamamoto", "Zandra Rhodes", "Thierry Mugler", "Azzedine Alaïa", "Gucci",
-    "Hermès", "Céline", "Christian Lacroix", "Valentino", "Gianfranco Ferré",
-    "Versace", "Donatella Versace", "Armani", "Moschino", "Claude Montana",
-    "Jean Paul Gaultier", "Yohji Yamamoto", "Helmut Lang", "Jil Sander", "Miuccia Prada",
-    "Prada", "Miu Miu", "Narciso Rodriguez", "Ann Demeulemeester", "Jean Colonna",
-    "Tom Ford", "John Galliano", "Alexander McQueen", "Hussein Chalayan", "Martin Margiela",
-    "Romeo Gigli", "Marc Jacobs", "Kate Spade", "Anna Sui", "Isaac Mizrahi",
-    "Todd Oldham", "Betsey Johnson", "Vivienne Westwood", "Katharine Hamnett",
-    "Nicolas Ghesquière", "Phoebe Philo", "Stefano Pilati", "Alber Elbaz",
-    "Riccardo Tisci", "Stella McCartney", "Proenza Schouler", "Zac Posen",
-    "Jason Wu", "Phillip Lim", "Rodarte", "Tory Burch", "Derek Lam", "Vera Wang",
-    "Isabel Marant", "Junya Watanabe", "Roberto Cavalli", "Etro", "Raf Simons",
-    "Hedi Slimane", "Alessandro Michele", "Sarah Burton", "Maria Grazia Chiuri",
-    "Demna", "Jonathan Anderson", "Clare Waight Keller", "Virginie Viard",
-    "Simone Rocha", "Cecilie Bahnsen", "The Row", "Christopher Kane", "Jacquemus",
-    "Rosie Assoulin", "Ulla Johnson", "Mother of Pearl", "Ganni", "Sies Marjan",
-    "Virgil Abloh", "Yoon Ahn", "Marine Serre", "Heron Preston", "Shayne Oliver",
-    "Peter Do", "Khaite", "Catherine Holstein", "Tove", "Bode", "Emily Adams Bode",
-    "Wales Bonner", "Lemaire", "Nensi Dojaka", "Area", "LaQuan Smith",
-    "Christopher John Rogers", "KNWLS", "Dilara Fındıkoğlu", "Mugler",
-    "Casey Cadwallader", "Schiaparelli", "Daniel Roseberry", "Jcrew", "Donna Karan",
-    "Escada", "Burberry", "Chloé", "Max Mara", "Theory",
-    "Madeleine Vionnet", "Elsa Schiaparelli", "Jean Patou", "Jeanne Lanvin",
-    "Nina Ricci", "Carven", "Madame Grès", "Paul Poiret", "Mainbocher",
-    "Jacques Fath", "Guy Laroche", "Courrèges",
-    "Liz Claiborne", "Anne Fogarty", "Lilli Ann", "Adrienne Vittadini",
-    "Stephen Sprouse", "Giorgio di Sant'Angelo", "Janice Wainwright",
-    "Fendi", "Trussardi", "Krizia", "Sportmax", "Genny", "Gianni Versace",
-    "Fiorucci", "Miss Deanna", "Blumarine", "Brioni", "Laura Biagiotti",
-    "Emilio Pucci", "Matsuda", "Comme des Garçons", "Tsumori Chisato",
-    "Dries Van Noten", "Dirk Bikkembergs", "Walter Van Beirendonck",
-    "Patrick Van Ommeslaeghe", "Hardy Amies", "Bruce Oldfield", "Jasper Conran", "Bella Freud",
-    "Matthew Williamson", "Ozwald Boateng", "John Richmond",
-    "Margaret Howell", "A.P.C.", "Acne Studios", "Rick Owens",
-    "Jean-Charles de Castelbajac", "Delvaux", "Loewe", "Mulberry", "Coach", "Bally", "Ferragamo",
-    "Cartier", "Tiffany", "Tiffany & Co", "Louis Vuitton", "Bottega Veneta",
-    "Filippa K", "Tiger of Sweden", "Weekday",
-    "BCBG Max Azria", "Baby Phat", "Heatherette", "Anna Molinari", "DSquared2", "Morgan de Toi",
-    "Dolce & Gabbana", "Dolce and Gabbana", "Levi's", "Levis", "Chanel", "Manolo Blahnik", "Timmy Woods"
-]
-
-# ENHANCED DESIGNER SYNONYMS with many more common variations
-DESIGNER_SYNONYMS = {
-    # Yves Saint Laurent variations
-    "ysl": "Yves Saint Laurent", "saint laurent": "Yves Saint Laurent",
-    "st laurent": "Yves Saint Laurent", "yves st laurent": "Yves Saint Laurent",
-    "saint laurent paris": "Yves Saint Laurent", "ysl rive gauche": "Yves Saint Laurent",
-    
-    # Christian Dior variations
-    "dior": "Christian Dior", "christian dior": "Christian Dior",
-    "dior homme": "Christian Dior", "baby dior": "Christian Dior",
-    "miss dior": "Christian Dior",
-    
-    # Balenciaga variations
-    "balenciaga": "Cristóbal Balenciaga", "cristobal balenciaga": "Cristóbal Balenciaga",
-    
-    # Givenchy variations
-    "givenchy": "Hubert de Givenchy", "givenchy sport": "Hubert de Givenchy",
-    "givenchy play": "Hubert de Givenchy",
-    
-    # Hermès variations
-    "hermes": "Hermès", "hermès": "Hermès",
-    
-    # Céline variations
-    "celine": "Céline", "céline": "Céline",
-    
-    # Gucci variations
-    "gucci": "Gucci", "tom ford for gucci": "Gucci",
-    
-    # Fendi variations
-    "fendi": "Fendi", "fendissime": "Fendi",
-    
-    # J.Crew variations
-    "jcrew": "Jcrew", "j crew": "Jcrew", "j.crew": "Jcrew",
-    
-    # Escada variations
-    "escada couture": "Escada", "escada sport": "Escada", 
-    "escada margaretha ley": "Escada", "escada": "Escada",
-    
-    # Armani variations
-    "armani exchange": "Armani", "emporio armani": "Armani", 
-    "giorgio armani": "Armani", "armani collezioni": "Armani",
-    "armani jeans": "Armani", "a/x armani exchange": "Armani",
-    "ax armani": "Armani", "ea7": "Armani",
-    
-    # Ralph Lauren variations
-    "polo ralph lauren": "Ralph Lauren", "ralph lauren collection": "Ralph Lauren",
-    "lauren ralph lauren": "Ralph Lauren", "polo sport": "Ralph Lauren",
-    "rrl": "Ralph Lauren", "double rl": "Ralph Lauren",
-    "ralph lauren purple label": "Ralph Lauren", "ralph lauren black label": "Ralph Lauren",
-    "polo by ralph lauren": "Ralph Lauren", "rl": "Ralph Lauren",
-    
-    # Donna Karan variations
-    "dkny": "Donna Karan", "donna karan new york": "Donna Karan", 
-    "dkny jeans": "Donna Karan", "dkny active": "Donna Karan",
-    
-    # Marc Jacobs variations
-    "marc by marc jacobs": "Marc Jacobs", "the marc jacobs": "Marc Jacobs",
-    "marc jacobs collection": "Marc Jacobs",
-    
-    # Versace variations
-    "versus versace": "Versace", "versace jeans": "Versace", 
-    "versace collection": "Versace", "gianni versace": "Gianni Versace",
-    "versace jeans couture": "Versace", "versace sport": "Versace",
-    "atelier versace": "Versace",
-    
-    # Prada variations
-    "miu miu": "Miu Miu", "prada sport": "Prada",
-    "prada linea rossa": "Prada",
-    
-    # Alexander McQueen variations
-    "mcq alexander mcqueen": "Alexander McQueen",
-    "alexander mcqueen": "Alexander McQueen", "mcq": "Alexander McQueen",
-    
-    # Chloé variations
-    "see by chloe": "Chloé", "see by chloé": "Chloé",
-    "chloe": "Chloé", "chloé": "Chloé",
-    
-    # Valentino variations
-    "red valentino": "Valentino", "valentino garavani": "Valentino",
-    "valentino red": "Valentino", "valentino roma": "Valentino",
-    
-    # Moschino variations
-    "moschino cheap and chic": "Moschino", "moschino cheap & chic": "Moschino", 
-    "love moschino": "Moschino", "moschino couture": "Moschino",
-    
-    # Missoni variations
-    "missoni sport": "Missoni", "m missoni": "Missoni",
-    "missoni mare": "Missoni",
-    
-    # Calvin Klein variations
-    "ck calvin klein": "Calvin Klein", "calvin klein jeans": "Calvin Klein",
-    "calvin klein collection": "Calvin Klein", "ckj": "Calvin Klein",
-    "ck": "Calvin Klein", "calvin klein underwear": "Calvin Klein",
-    "calvin klein performance": "Calvin Klein",
-    
-    # Vivienne Westwood variations
-    "vivienne westwood red label": "Vivienne Westwood", 
-    "vivienne westwood gold label": "Vivienne Westwood",
-    "vivienne westwood anglomania": "Vivienne Westwood",
-    "vivienne westwood man": "Vivienne Westwood",
-    
-    # Burberry variations
-    "burberry prorsum": "Burberry", "burberry brit": "Burberry", 
-    "burberry london": "Burberry", "burberry sport": "Burberry",
-    "burberry check": "Burberry", "burberrys": "Burberry",
-    
-    # London Fog variations
-    "london fog": "London Fog",
+# Extraction results keyed on the normalized text (all extractors read only
+# that) and the vocabulary version; 0 disables the cache
+EXTRACTION_CACHE_SIZE = int(os.environ.get("EXTRACTION_CACHE_SIZE", "10000"))
+extraction_cache = Cache(EXTRACTION_CACHE_SIZE)
 
-     # Jimmy Choo variations
-    "Jimmy Choo": "Jimmy Choo",
+def build_metafields_payload(product_id: int, text: str) -> dict:
+    vocab = get_vocabulary()
+    with STAGE_SECONDS.time(stage="normalize"):
+        norm = normalize(text)
+    key = (vocab.version, hashlib.blake2b(norm.text.encode("utf-8"), digest_size=16).digest())
+    metafields = extraction_cache.get(key)
+    if metafields is None:
+        with STAGE_SECONDS.time(stage="phrase_scan"):
+            hits = vocab.scan(norm.text)
+        metafields = extract_metafields(norm, hits, vocab)
+        extraction_cache.set(key, metafields)
+    # Copies, so callers can't alter the cached entry
+    return {
+        "product_id": product_id,
+        "metafields": [dict(mf) for mf in metafields],
+        "vocabulary_version": vocab.version,
+    }
 
-     # Chanel variations
-    "Karl Lagerfeld": "Chanel",
-    
-    # Theory variations
-    "theory": "Theory",
-    
-    # Helmut Lang variations
-    "helmut lang": "Helmut Lang", "helmut lang jeans": "Helmut Lang",
-    
-    # Max Mara variations
-    "max mara studio": "Max Mara", "sportmax": "Max Mara", 
-    "weekend max mara": "Max Mara", "maxmara": "Max Mara",
-    "max & co": "Max Mara", "max and co": "Max Mara",
-    
-    # Comme des Garçons variations
-    "comme des garcons": "Comme des Garçons", "cdg": "Comme des Garçons",
-    "comme des garçons homme plus": "Comme des Garçons", 
-    "comme des garçons ganryu": "Comme des Garçons",
-    "comme des garçons tricot": "Comme des Garçons",
-    "comme des garcons play": "Comme des Garçons",
-    "cdg play": "Comme des Garçons",
-    
-    # Issey Miyake variations
-    "issey miyake pleats please": "Issey Miyake",
-    "pleats please": "Issey Miyake", "pleats please issey miyake": "Issey Miyake",
-    "haat issey miyake": "Issey Miyake",
-    
-    # Junya Watanabe variations
-    "junya watanabe man": "Junya Watanabe",
-    "junya watanabe cdg": "Junya Watanabe",
-    
-    # BCBG variations
-    "bcbg": "BCBG Max Azria", "bcbg max azria": "BCBG Max Azria",
-    "bcbgmaxazria": "BCBG Max Azria", "bcbgeneration": "BCBG Max Azria",
-    
-    # Roberto Cavalli variations
-    "roberto cavalli class": "Roberto Cavalli", "just cavalli": "Roberto Cavalli", 
-    "cavalli": "Roberto Cavalli", "cavalli class": "Roberto Cavalli",
-    
-    # Emanuel Ungaro variations
-    "emanuel ungaro parallele": "Emanuel Ungaro", "ungaro": "Emanuel Ungaro",
-    
-    # Jil Sander variations
-    "jil sander navy": "Jil Sander", "jil sander +": "Jil Sander",
-    
-    # Kenzo variations
-    "kenzo jungle": "Kenzo Takada", "kenzo": "Kenzo Takada",
-    
-    # Ann Demeulemeester variations
-    "ann demeulemeester menswear": "Ann Demeulemeester",
-    
-    # Romeo Gigli variations
-    "romeo gigli menswear": "Romeo Gigli",
-    
-    # DSquared2 variations
-    "dsquared2": "DSquared2", "dsquared": "DSquared2",
-    "d squared": "DSquared2", "d2": "DSquared2",
-    
-    # Tiffany & Co variations
-    "tiffany & co": "Tiffany & Co", "tiffany and co": "Tiffany & Co", 
-    "tiffany": "Tiffany & Co", "tiffany co": "Tiffany & Co",
-    
-    # Cartier variations
-    "cartier": "Cartier",
-    
-    # Louis Vuitton variations
-    "lv": "Louis Vuitton", "louis vuitton": "Louis Vuitton",
-    "vuitton": "Louis Vuitton",
-    
-    # Bottega Veneta variations
-    "bottega veneta": "Bottega Veneta", "bottega": "Bottega Veneta",
-    "bv": "Bottega Veneta",
-    
-    # Additional common variations
-    "ferragamo": "Ferragamo", "salvatore ferragamo": "Ferragamo",
-    "balmain": "Balmain", "pierre balmain": "Balmain",
-    "lanvin": "Lanvin", "jeanne lanvin": "Jeanne Lanvin",
-    "acne": "Acne Studios", "acne studios": "Acne Studios",
-    "apc": "A.P.C.", "a.p.c.": "A.P.C.",
-    "rag & bone": "Rag & Bone", "rag and bone": "Rag & Bone",
-    
-    # Dolce & Gabbana variations
-    "dolce & gabbana": "Dolce & Gabbana", "dolce and gabbana": "Dolce & Gabbana",
-    "d&g": "Dolce & Gabbana", "d & g": "Dolce & Gabbana",
-    "dolce gabbana": "Dolce & Gabbana", "dolce": "Dolce & Gabbana",
-    
-    # Levi's variations
-    "levi's": "Levi's", "levis": "Levi's", "levi strauss": "Levi's",
-    "levis strauss": "Levi's", "levi": "Levi's",
-}
+async def write_metafields_to_shopify(product_id: int, metafields: list[dict]) -> list[dict] | None:
+    if not SHOPIFY_API_TOKEN or not SHOPIFY_STORE_DOMAIN:
+        print("Shopify credentials missing; skipping metafield write.")
+        return None
 
-def extract_designer(text: str) -> str:
-    text_l = text.lower()
-    print(f"[DEBUG] Searching for designer in: {text_l[:100]}...")
-    
-    # Check synonyms first (longest to shortest to match most specific first)
-    for syn, canonical in sorted(DESIGNER_SYNONYMS.items(), key=lambda x: len(x[0]), reverse=True):
-        # Special handling for patterns with special characters
-        escaped = re.escape(syn)
-        # Replace escaped spaces with flexible whitespace matcher
-        escaped = escaped.replace(r'\ ', r'\s+')
-        
-        # For patterns with & or other special chars, use lookaround instead of \b
-        if '&' in syn or any(c in syn for c in ['&', '-', '/', '.']):
-            # Use word boundary at start and whitespace/punctuation/end at the end
-            pattern = r'(?<!\w)' + escaped + r'(?!\w)'
-        else:
-            pattern = r'\b' + escaped + r'\b'
-        
-        if re.search(pattern, text_l):
-            print(f"[DEBUG] Found designer via synonym '{syn}' -> {canonical}")
-            return canonical
-    
-    # Check main designer list
-    for designer in sorted(DESIGNERS, key=len, reverse=True):
-        designer_lower = designer.lower()
-        escaped = re.escape(designer_lower)
-        escaped = escaped.replace(r'\ ', r'\s+')
-        
-        # For patterns with special chars, use lookaround instead of \b
-        if '&' in designer_lower or any(c in designer_lower for c in ['&', '-', '/', '.']):
-            pattern = r'(?<!\w)' + escaped + r'(?!\w)'
+    print(f"Attempting to set {len(metafields)} metafields on product {product_id}")
+    results = await write_changed_metafields(
+        get_client(), SHOPIFY_STORE_DOMAIN, SHOPIFY_API_TOKEN, product_id, metafields,
+    )
+    for result in results:
+        if result.get("skipped"):
+            print(f"Metafield unchanged, not written: {result['key']}")
+        elif result["ok"]:
+            print(f"Successfully created metafield: {result['key']}")
         else:
-            pattern = r'\b' + escaped + r'\b'
-        
-        if re.search(pattern, text_l):
-            print(f"[DEBUG] Found designer in main list: {designer}")
-            return designer
-    
-    print(f"[DEBUG] No designer found, returning 'unbranded'")
-    return "unbranded"
-
-# ENHANCED CONDITION MAP with more variations
-CONDITION_MAP = {
-    # NEW conditions
-    "new with tags": "NEW", "nwt": "NEW", "brand new": "NEW", "never worn": "NEW",
-    "new without tags": "NEW", "nwot": "NEW", "deadstock": "NEW",
-    "brand new with tags": "NEW", "bnwt": "NEW", "still has tags": "NEW",
-    "tags attached": "NEW", "new in bag": "NEW", "new in box": "NEW",
-    "nib": "NEW", "unused": "NEW", "unworn": "NEW",
-    
-    # LIKE NEW conditions
-    "like new": "LIKE NEW", "mint": "LIKE NEW", "mint condition": "LIKE NEW", 
-    "pristine": "LIKE NEW", "perfect condition": "LIKE NEW", "as new": "LIKE NEW",
-    "virtually new": "LIKE NEW", "nearly new": "LIKE NEW", "barely worn": "LIKE NEW",
-    "worn once": "LIKE NEW", "worn 1x": "LIKE NEW", "like-new": "LIKE NEW",
-    "pristine condition": "LIKE NEW", "flawless": "LIKE NEW", "flawless condition": "LIKE NEW",
-    
-    # EXCELLENT conditions
-    "excellent": "EXCELLENT", "excellent condition": "EXCELLENT", 
-    "near mint": "EXCELLENT", "near-mint": "EXCELLENT", "exc condition": "EXCELLENT",
-    "exc": "EXCELLENT", "euc": "EXCELLENT", "excellent used condition": "EXCELLENT",
-    "excellent pre-owned": "EXCELLENT", "excellent preowned": "EXCELLENT",
-    
-    # VERY GOOD conditions
-    "very good": "VERY GOOD", "very good condition": "VERY GOOD", 
-    "very good pre-owned condition": "VERY GOOD", "vgc": "VERY GOOD",
-    "great condition": "VERY GOOD", "gently used": "VERY GOOD",
-    "very good used condition": "VERY GOOD", "minimal wear": "VERY GOOD",
-    "light wear": "VERY GOOD", "gently worn": "VERY GOOD",
-    
-    # GOOD conditions
-    "good": "GOOD", "good condition": "GOOD", "lightly used": "GOOD", 
-    "pre-owned": "GOOD", "preowned": "GOOD", "gc": "GOOD",
-    "good used condition": "GOOD", "good vintage condition": "GOOD",
-    "normal wear": "GOOD", "moderate wear": "GOOD", "some signs of wear": "GOOD",
-    
-    # FAIR conditions
-    "fair": "FAIR", "fair condition": "FAIR", "shows wear": "FAIR", 
-    "some wear": "FAIR", "well-loved": "FAIR", "vintage condition": "FAIR",
-    "well worn": "FAIR", "visible wear": "FAIR", "noticeable wear": "FAIR",
-    "fair vintage": "FAIR", "loved": "FAIR",
-    
-    # POOR conditions
-    "poor": "POOR", "for parts": "POOR", "damaged": "POOR", 
-    "heavily worn": "POOR", "poor condition": "POOR", "as is": "POOR",
-    "as-is": "POOR", "needs repair": "POOR", "needs work": "POOR",
-    "distressed": "POOR", "major flaws": "POOR",
-}
+            print(f"Error from Shopify metafields: {result['key']} {result['error']}")
+    return results
 
-def extract_condition(text: str) -> str | None:
-    t = text.lower()
-    print(f"[DEBUG] Searching for condition in: {t[:100]}...")
-    
-    # Sort by length (longest first) to match most specific phrases first
-    for phrase in sorted(CONDITION_MAP.keys(), key=len, reverse=True):
-        escaped = re.escape(phrase)
-        # Replace escaped spaces with flexible whitespace
-        escaped = escaped.replace(r'\ ', r'\s+')
-        
-        # Use word boundaries to prevent matching within words
-        pattern = r'\b' + escaped + r'\b'
-        
-        if re.search(pattern, t):
-            print(f"[DEBUG] Found condition via phrase '{phrase}' -> {CONDITION_MAP[phrase]}")
-            return CONDITION_MAP[phrase]
-    
-    print(f"[DEBUG] No condition found")
-    return None
+async def process_product_webhook(data: dict):
+    product_id = data.get("id")
+    title = data.get("title") or ""
+    body_html = data.get("body_html") or ""
 
-# ENHANCED COLORS with more variations
-COLORS = [
-    # Black variations
-    "Black", "Jet Black", "Pure Black", "True Black", "Onyx", "Ebony",
-    
-    # White variations
-    "White", "Pure White", "Bright White", "Snow White", "Ivory", "Cream", 
-    "Off-white", "Ecru", "Eggshell", "Bone", "Warm White", "Cool White",
-    
-    # Beige/Tan/Brown variations
-    "Beige", "Tan", "Brown", "Chocolate", "Camel", "Sand", "Stone",
-    "Oatmeal", "Taupe", "Mocha", "Mahogany", "Chestnut", "Cognac",
-    "Saddle", "Wheat", "Flax", "Straw", "Champagne", "Biscuit",
-    "Khaki", "Walnut", "Espresso", "Sienna", "Umber", "Cinnamon",
-    "Ginger", "Honey", "Amber", "Bronze", "Brass", "Copper",
-    "Rust", "Terracotta", "Burnt Orange",
-    
-    # Blue variations
-    "Navy", "Blue", "Light Blue", "Sky Blue", "Baby Blue", "Cobalt",
-    "Royal Blue", "Teal", "Turquoise", "Denim Blue", "Powder Blue",
-    "Cerulean", "Azure", "Sapphire", "Denim", "Peacock", "Aegean",
-    "Ocean", "Marine", "Aqua", "Cyan", "Pool", "Caribbean",
-    "Electric Blue", "Midnight Blue", "Periwinkle", "Indigo",
-    "Ice Blue", "Steel Blue",
-    
-    # Green variations
-    "Green", "Olive", "Forest Green", "Hunter Green", "Mint", "Sage",
-    "Emerald", "Lime", "Seafoam", "Pistachio", "Jade", "Kelly Green",
-    "Grass", "Clover", "Moss", "Olive Drab", "Army Green", "Avocado",
-    "Pear", "Spring Green", "Neon Green", "Chartreuse",
-    
-    # Yellow/Gold variations
-    "Yellow", "Mustard", "Gold", "Butter", "Lemon", "Canary",
-    "Sunflower", "Marigold", "Saffron", "Ochre",
-    
-    # Orange variations
-    "Orange", "Coral", "Peach", "Apricot", "Tangerine", "Melon",
-    "Cantaloupe", "Papaya", "Mango", "Persimmon", "Pumpkin",
-    "Carrot", "Flame", "Blood Orange", "Vermillion",
-    
-    # Red variations
-    "Red", "Burgundy", "Maroon", "Fire Red", "Wine Red", "Wine",
-    "Oxblood", "Garnet", "Ruby", "Crimson", "Scarlet", "Tomato",
-    "Brick", "Cherry", "Cranberry",
-    
-    # Pink variations
-    "Pink", "Blush", "Hot Pink", "Magenta", "Fuchsia", "Rose",
-    "Dusty Rose", "Shocking Pink", "Bubblegum", "Carnation",
-    "Salmon", "Neon Pink",
-    
-    # Purple variations
-    "Purple", "Lavender", "Lilac", "Plum", "Aubergine", "Eggplant",
-    "Grape", "Mulberry", "Berry", "Orchid", "Mauve", "Wisteria",
-    "Violet", "Iris", "Amethyst", "Raisin",
-    
-    # Grey variations
-    "Grey", "Gray", "Charcoal", "Silver", "Graphite", "Smoke",
-    "Dove Grey", "Heather Grey", "Slate", "Steel", "Gunmetal",
-    "Ash", "Pewter", "Lead", "Iron", "Charcoal Grey",
-    
-    # Metallic variations
-    "Nickel", "Titanium", "Platinum", "Chrome", "Mercury",
-    "Metallic", "Gold", "Silver", "Bronze", "Copper",
-    
-    # Multi-color
-    "Multicolor", "Multi-color", "Multi", "Print", "Patterned",
-    "Floral", "Striped", "Polka Dot", "Animal Print", "Leopard",
-    "Zebra", "Tie-dye", "Rainbow",
-]
-
-def extract_colors(text: str) -> list[str]:
-    t = text.lower()
-    found: list[str] = []
-    
-    # Sort by length (longest first) to match compound colors before simple ones
-    for c in sorted(COLORS, key=len, reverse=True):
-        c_lower = c.lower()
-        escaped = re.escape(c_lower)
-        # Replace escaped spaces with flexible whitespace
-        escaped = escaped.replace(r'\ ', r'\s+')
-        
-        # Use word boundaries to prevent matching within words (e.g., "Red" in "Fred")
-        pattern = r'\b' + escaped + r'\b'
-        
-        if re.search(pattern, t) and c not in found:
-            found.append(c)
-    
-    return found
-
-# ENHANCED PRODUCT_TYPES with more variations
-PRODUCT_TYPES = {
-    # Dress variations
-    "babydoll dress": "Dress", "bodycon dress": "Dress", "cocktail dress": "Dress",
-    "empire waist dress": "Dress", "evening gown": "Dress", "fit-and-flare dress": "Dress",
-    "halter dress": "Dress", "kaftan dress": "Dress", "maxi dress": "Dress",
-    "midi dress": "Dress", "mini dress": "Dress", "one-shoulder dress": "Dress",
-    "shirt dress": "Dress", "sheath dress": "Dress", "shift dress": "Dress",
-    "slip dress": "Dress", "sun dress": "Dress", "sweater dress": "Dress",
-    "wrap dress": "Dress", "a-line dress": "Dress", "backless dress": "Dress",
-    "gown": "Dress", "dress": "Dress", "cocktail gown": "Dress",
-    "ball gown": "Dress", "party dress": "Dress", "summer dress": "Dress",
-    "day dress": "Dress", "casual dress": "Dress", "formal dress": "Dress",
-    "long dress": "Dress", "short dress": "Dress", "sleeveless dress": "Dress",
-    "long sleeve dress": "Dress", "strapless dress": "Dress",
-    
-    # Tops variations
-    "button-down shirt": "Tops", "button down": "Tops", "button up": "Tops",
-    "off-the-shoulder top": "Tops", "off shoulder top": "Tops",
-    "one-shoulder top": "Tops", "crop top": "Tops", "cropped top": "Tops",
-    "tube top": "Tops", "wrap top": "Tops", "corset top": "Tops",
-    "peplum top": "Tops", "halter top": "Tops", "shell top": "Tops", 
-    "knit top": "Tops", "tank top": "Tops", "tank": "Tops",
-    "t-shirt": "Tops", "tee": "Tops", "tee shirt": "Tops",
-    "camisole": "Tops", "cami": "Tops", "blouse": "Tops",
-    "polo shirt": "Tops", "polo": "Tops", "tunic": "Tops", 
-    "sweater": "Tops", "cardigan": "Tops", "pullover": "Tops",
-    "bodysuit": "Tops", "body suit": "Tops", "sweatshirt": "Tops",
-    "hoodie": "Tops", "vest": "Tops", "bustier": "Tops",
-    "bralette": "Tops", "top": "Tops", "shirt": "Tops",
-    "long sleeve top": "Tops", "short sleeve top": "Tops",
-    "sleeveless top": "Tops", "v-neck": "Tops", "crew neck": "Tops",
-    
-    # Jackets / Blazers variations
-    "trench coat": "Jackets / Blazers", "trench": "Jackets / Blazers",
-    "peacoat": "Jackets / Blazers", "pea coat": "Jackets / Blazers",
-    "duster coat": "Jackets / Blazers", "duster": "Jackets / Blazers",
-    "car coat": "Jackets / Blazers", "puffer jacket": "Jackets / Blazers",
-    "puffer": "Jackets / Blazers", "quilted jacket": "Jackets / Blazers",
-    "bomber jacket": "Jackets / Blazers", "bomber": "Jackets / Blazers",
-    "leather jacket": "Jackets / Blazers", "denim jacket": "Jackets / Blazers",
-    "jean jacket": "Jackets / Blazers", "moto jacket": "Jackets / Blazers",
-    "motorcycle jacket": "Jackets / Blazers", "wool coat": "Jackets / Blazers",
-    "fur coat": "Jackets / Blazers", "faux fur coat": "Jackets / Blazers",
-    "suit jacket": "Jackets / Blazers", "blazer": "Jackets / Blazers",
-    "overcoat": "Jackets / Blazers", "cape": "Jackets / Blazers",
-    "poncho": "Jackets / Blazers", "raincoat": "Jackets / Blazers",
-    "windbreaker": "Jackets / Blazers", "parka": "Jackets / Blazers",
-    "jacket": "Jackets / Blazers", "coat": "Jackets / Blazers",
-    "outerwear": "Jackets / Blazers", "winter coat": "Jackets / Blazers",
-    "spring jacket": "Jackets / Blazers", "overshirt": "Jackets / Blazers",
-    "shacket": "Jackets / Blazers", "shirt jacket": "Jackets / Blazers",
-    
-    # Pants variations
-    "wide-leg pants": "Pants", "wide leg pants": "Pants",
-    "straight-leg pants": "Pants", "straight leg pants": "Pants",
-    "skinny pants": "Pants", "palazzo pants": "Pants",
-    "harem pants": "Pants", "dress pants": "Pants",
-    "cargo pants": "Pants", "cargo": "Pants",
-    "bermuda shorts": "Pants", "denim shorts": "Pants",
-    "jeans": "Pants", "denim": "Pants", "trousers": "Pants",
-    "sweatpants": "Pants", "joggers": "Pants", "leggings": "Pants",
-    "culottes": "Pants", "capris": "Pants", "capri pants": "Pants",
-    "shorts": "Pants", "skort": "Pants", "trouser pant": "Pants",
-    "trouser pants": "Pants", "trouser": "Pants", "pants": "Pants",
-    "slacks": "Pants", "chinos": "Pants", "khakis": "Pants",
-    "athletic pants": "Pants", "track pants": "Pants",
-    
-    # Skirts variations
-    "mini skirt": "Skirts", "miniskirt": "Skirts",
-    "midi skirt": "Skirts", "maxi skirt": "Skirts",
-    "pencil skirt": "Skirts", "a-line skirt": "Skirts",
-    "pleated skirt": "Skirts", "slip skirt": "Skirts",
-    "wrap skirt": "Skirts", "circle skirt": "Skirts",
-    "tiered skirt": "Skirts", "denim skirt": "Skirts",
-    "leather skirt": "Skirts", "skirt": "Skirts",
-    "long skirt": "Skirts", "short skirt": "Skirts",
-    
-    # Bags variations
-    "shoulder bag": "Bags", "crossbody bag": "Bags", "cross body bag": "Bags",
-    "messenger bag": "Bags", "satchel bag": "Bags", "satchel": "Bags",
-    "hobo bag": "Bags", "bucket bag": "Bags", "saddle bag": "Bags",
-    "bowler bag": "Bags", "doctor bag": "Bags", "frame bag": "Bags", 
-    "box bag": "Bags", "top handle bag": "Bags", "top-handle": "Bags",
-    "tote bag": "Bags", "shopping bag": "Bags", "beach bag": "Bags",
-    "weekender bag": "Bags", "duffle bag": "Bags", "duffel bag": "Bags",
-    "travel bag": "Bags", "clutch bag": "Bags", "envelope clutch": "Bags",
-    "minaudiere": "Bags", "wristlet": "Bags", "evening bag": "Bags",
-    "backpack": "Bags", "rucksack": "Bags", "drawstring bag": "Bags",
-    "pouchette": "Bags", "pochette": "Bags", "pouch": "Bags",
-    "makeup bag": "Bags", "cosmetic bag": "Bags", "coin purse": "Bags",
-    "wallet": "Bags", "cardholder": "Bags", "card case": "Bags",
-    "card holder": "Bags", "bag": "Bags", "purse": "Bags", 
-    "handbag": "Bags", "clutch": "Bags", "tote": "Bags",
-    
-    # Heels variations
-    "ankle-strap heels": "Heels", "ankle strap heels": "Heels",
-    "slingback heels": "Heels", "peep-toe heels": "Heels",
-    "peep toe heels": "Heels", "platform heels": "Heels",
-    "t-strap heels": "Heels", "mary jane heels": "Heels",
-    "d'orsay heels": "Heels", "dorsay heels": "Heels",
-    "block heels": "Heels", "kitten heels": "Heels",
-    "wedge heels": "Heels", "stilettos": "Heels", "stiletto": "Heels",
-    "pumps": "Heels", "heels": "Heels", "high heels": "Heels",
-    "heel": "Heels", "pump": "Heels",
-    
-    # Boots variations
-    "over-the-knee boots": "Boots", "over the knee boots": "Boots",
-    "otk boots": "Boots", "thigh-high boots": "Boots",
-    "thigh high boots": "Boots", "knee-high boots": "Boots",
-    "knee high boots": "Boots", "mid-calf boots": "Boots",
-    "ankle boots": "Boots", "booties": "Boots", "bootie": "Boots",
-    "chelsea boots": "Boots", "cowboy boots": "Boots",
-    "western boots": "Boots", "combat boots": "Boots",
-    "moto boots": "Boots", "motorcycle boots": "Boots",
-    "sock boots": "Boots", "platform boots": "Boots",
-    "wedge boots": "Boots", "rain boots": "Boots",
-    "snow boots": "Boots", "hiking boots": "Boots", "boots": "Boots",
-    "winter boots": "Boots", "boot": "Boots",
-    
-    # Flats variations
-    "mary jane flats": "Flats", "mary janes": "Flats",
-    "pointed-toe flats": "Flats", "pointed toe flats": "Flats",
-    "oxford flats": "Flats", "oxfords": "Flats",
-    "derby flats": "Flats", "espadrille flats": "Flats",
-    "smoking slippers": "Flats", "ballet flats": "Flats",
-    "loafers": "Flats", "moccasins": "Flats", "flats": "Flats",
-    "slip-ons": "Flats", "slip ons": "Flats", "flat": "Flats",
-    
-    # Sandals variations
-    "gladiator sandals": "Sandals", "strappy sandals": "Sandals",
-    "t-strap sandals": "Sandals", "fisherman sandals": "Sandals",
-    "espadrille sandals": "Sandals", "platform sandals": "Sandals",
-    "wedge sandals": "Sandals", "flat sandals": "Sandals",
-    "thong sandals": "Sandals", "flip-flops": "Sandals",
-    "flip flops": "Sandals", "slides": "Sandals", "slide sandals": "Sandals",
-    "sandals": "Sandals", "sandal": "Sandals",
-    
-    # Sneakers variations
-    "high-top sneakers": "Sneakers", "high top sneakers": "Sneakers",
-    "low-top sneakers": "Sneakers", "low top sneakers": "Sneakers",
-    "platform sneakers": "Sneakers", "slip-on sneakers": "Sneakers",
-    "slip on sneakers": "Sneakers", "dad sneakers": "Sneakers",
-    "chunky sneakers": "Sneakers", "running sneakers": "Sneakers",
-    "fashion sneakers": "Sneakers", "court sneakers": "Sneakers",
-    "canvas sneakers": "Sneakers", "sneakers": "Sneakers",
-    "trainers": "Sneakers", "tennis shoes": "Sneakers",
-    "athletic shoes": "Sneakers", "sneaker": "Sneakers",
-    "trainer": "Sneakers",
-    
-    # Mules variations
-    "platform clogs": "Mules", "mule heels": "Mules",
-    "mule flats": "Mules", "clogs": "Mules", "mules": "Mules",
-    "shearling slippers": "Mules", "house slippers": "Mules",
-    "slippers": "Mules", "mule": "Mules", "clog": "Mules",
-    "slipper": "Mules",
-    
-    # Jewelry - Necklaces
-    "statement necklace": "Necklace", "pendant necklace": "Necklace",
-    "chain necklace": "Necklace", "choker necklace": "Necklace",
-    "choker": "Necklace", "collar necklace": "Necklace",
-    "collar": "Necklace", "bib necklace": "Necklace",
-    "lariat necklace": "Necklace", "pearl necklace": "Necklace",
-    "rope necklace": "Necklace", "necklace": "Necklace",
-    "pendant": "Necklace", "chain": "Necklace",
-    
-    # Jewelry - Earrings
-    "statement earrings": "Earrings", "drop earrings": "Earrings",
-    "dangle earrings": "Earrings", "chandelier earrings": "Earrings",
-    "hoop earrings": "Earrings", "hoops": "Earrings",
-    "stud earrings": "Earrings", "studs": "Earrings",
-    "clip-on earrings": "Earrings", "clip on earrings": "Earrings",
-    "ear cuffs": "Earrings", "ear cuff": "Earrings",
-    "earrings": "Earrings",
-    
-    # Jewelry - Bracelets
-    "charm bracelet": "Bracelet", "bangle bracelet": "Bracelet",
-    "bangle": "Bracelet", "cuff bracelet": "Bracelet",
-    "cuff": "Bracelet", "chain bracelet": "Bracelet",
-    "tennis bracelet": "Bracelet", "beaded bracelet": "Bracelet",
-    "friendship bracelet": "Bracelet", "bracelet": "Bracelet",
-    
-    # Jewelry - Rings
-    "statement ring": "Ring", "cocktail ring": "Ring",
-    "signet ring": "Ring", "band ring": "Ring",
-    "stackable ring": "Ring", "midi ring": "Ring",
-    "knuckle ring": "Ring", "ring": "Ring",
-    
-    # Jewelry - Brooches/Pins
-    "vintage brooch": "Brooch", "cameo brooch": "Brooch",
-    "crystal brooch": "Brooch", "floral brooch": "Brooch",
-    "animal brooch": "Brooch", "brooch": "Brooch",
-    "enamel pin": "Brooch", "lapel pin": "Brooch",
-    "hat pin": "Brooch", "pin": "Brooch",
-    
-    # Accessories - Belts
-    "statement belt": "Belt", "chain belt": "Belt",
-    "leather belt": "Belt", "wide belt": "Belt", 
-    "skinny belt": "Belt", "obi belt": "Belt", 
-    "corset belt": "Belt", "belt": "Belt",
-    "waist belt": "Belt",
-
-    # Accessories - Sunglasses
-    "sunglasses": "Sunglasses", "Sunglasses": "Sunglasses", 
-    "Sunglass": "Sunglasses", "Shades": "Sunglasses", 
-    "Eyewear": "Sunglasses",
-    
-    # Accessories - Scarves
-    "silk scarf": "Scarf", "cashmere scarf": "Scarf",
-    "wool scarf": "Scarf", "pashmina": "Scarf", 
-    "infinity scarf": "Scarf", "square scarf": "Scarf", 
-    "oblong scarf": "Scarf", "scarf": "Scarf",
-    "shawl": "Scarf", "wrap": "Scarf",
-    
-    # Accessories - Gloves
-    "leather gloves": "Gloves", "driving gloves": "Gloves",
-    "evening gloves": "Gloves", "opera gloves": "Gloves",
-    "fingerless gloves": "Gloves", "gloves": "Gloves",
-}
+    text = product_text(title, body_html)
 
-def extract_type(text: str) -> str | None:
-    t = text.lower()
-    print(f"[DEBUG] Searching for product type in: {t[:100]}...")
-    
-    # Sort by length (longest first) to match most specific types first
-    for phrase in sorted(PRODUCT_TYPES.keys(), key=len, reverse=True):
-        escaped = re.escape(phrase)
-        # Replace escaped spaces with flexible whitespace matcher
-        escaped = escaped.replace(r'\ ', r'\s+')
-        
-        # Use word boundaries to prevent matching within words
-        pattern = r'\b' + escaped + r'\b'
-        
-        if re.search(pattern, t):
-            print(f"[DEBUG] Found product type via phrase '{phrase}' -> {PRODUCT_TYPES[phrase]}")
-            return PRODUCT_TYPES[phrase]
-    
-    print(f"[DEBUG] No product type found")
-    return None
-
-def extract_era(text: str) -> str | None:
-    t = text.lower()
-    # 1960s variations
-    if any(x in t for x in ["1960s", "60s", "sixties", "'60s", "1960's", "60's",
-                             "mod era", "youthquake", "space age", "vintage 60s", 
-                             "twiggy", "mod style", "swinging sixties"]):
-        return "1960s"
-    # 1970s variations
-    if any(x in t for x in ["1970s", "70s", "seventies", "'70s", "1970's", "70's",
-                             "disco era", "boho era", "hippie era", "studio 54", 
-                             "vintage 70s", "disco", "bohemian 70s"]):
-        return "1970s"
-    # 1980s variations
-    if any(x in t for x in ["1980s", "80s", "eighties", "'80s", "1980's", "80's",
-                             "power dressing", "shoulder pad era", "vintage 80s", 
-                             "new wave", "power suit", "80s glam"]):
-        return "1980s"
-    # 1990s variations
-    if any(x in t for x in ["1990s", "90s", "nineties", "'90s", "1990's", "90's",
-                             "grunge", "minimalist era", "supermodel era", 
-                             "vintage 90s", "90s minimalism"]):
-        return "1990s"
-    # 2000s variations
-    if any(x in t for x in ["y2k", "2000s", "00s", "'00s", "early 2000s", "aughts",
-                             "mcbling", "millennium fashion", "paris hilton era",
-                             "2000's", "00's", "y2k aesthetic"]):
-        return "2000s / Y2K"
-    # 2010s variations
-    if any(x in t for x in ["2010s", "10s", "'10s", "early 2010s", "2010's",
-                             "normcore", "athleisure", "streetwear era"]):
-        return "2010s"
-    # Spring/Summer variations
-    if any(x in t for x in ["spring/summer", "spring summer", "s/s", "ss", 
-                             "resort", "cruise", "ss20", "ss21", "ss22", "ss23", "ss24"]):
-        return "Spring/Summer"
-    # Fall/Winter variations
-    if any(x in t for x in ["fall/winter", "fall winter", "f/w", "fw", 
-                             "autumn/winter", "aw", "fw20", "fw21", "fw22", "fw23", "fw24"]):
-        return "Fall/Winter"
-    return None
-
-# ENHANCED MATERIALS with more variations
-MATERIALS = [
-    # Cotton variations
-    "Organic cotton", "Pima cotton", "Supima cotton", "Egyptian cotton",
-    "Cotton", "Cotton blend",
-    
-    # Linen variations
-    "Flax", "Linen", "Hemp", "Linen blend",
-    
-    # Silk variations
-    "Mulberry silk", "Charmeuse", "Chiffon", "Organza", "Crepe de chine",
-    "Twill silk", "Silk", "Crushed velvet", "Silk velvet", "Velvet", 
-    "Satin", "Silk satin", "Satin silk",
-    
-    # Rayon/Modal variations
-    "Modal", "Lyocell", "Tencel", "Cupro", "Viscose", "Rayon", 
-    "Bamboo", "Acetate", "Rayon blend",
-    
-    # Polyester variations
-    "Recycled polyester", "Polyester", "Recycled nylon", "Nylon",
-    "Spandex", "Elastane", "Lycra", "Acrylic", "Polyamide", 
-    "Polyurethane", "Poly blend",
-    
-    # Leather variations
-    "Vegan leather", "Faux leather", "PU leather", "Bonded leather",
-    "Cowhide", "Sheepskin", "Lambskin", "Goatskin", "Pigskin",
-    "Leather", "Suede", "Nubuck", "Patent leather", "Shearling",
-    "Genuine leather", "Full grain leather", "Top grain leather",
-    
-    # Wool variations
-    "Merino wool", "Cashmere", "Mongolian cashmere", "Alpaca",
-    "Mohair", "Angora", "Camel hair", "Yak wool", "Wool", 
-    "Tweed", "Bouclé", "Boucle", "Felted wool", "Virgin wool",
-    "Wool blend",
-    
-    # Jersey/Knit variations
-    "Cotton jersey", "Wool jersey", "Silk jersey", "Jersey",
-    "Rib knit", "Chunky knit", "Cable knit", "Pointelle", "Knit",
-    "Interlock", "Double knit",
-    
-    # Other fabrics
-    "Sherpa", "Fleece", "French terry", "Terry cloth",
-    "Neoprene", "Power mesh", "Mesh", "Tulle", 
-    "Guipure lace", "Embroidered lace", "Lace",
-    "Broderie anglaise", "Eyelet", "Brocade", "Jacquard",
-    
-    # Denim variations
-    "Raw denim", "Stretch denim", "Denim", "Corduroy", 
-    "Canvas", "Poplin", "Twill", "Gabardine",
-    
-    # Other materials
-    "Crepe", "Georgette", "Scuba", "Sequins", "Beaded", 
-    "Embellished", "Metallic fabric", "Lamé", "Lame", "Foil fabric",
-    
-    # Synthetic variations
-    "Leatherette", "Rubber", "PVC", "Vinyl", "Plastic",
-    
-    # Natural materials
-    "Raffia", "Jute", "Straw", "Wicker", "Patent synthetic", 
-    "Microfiber",
-    
-    # Technical fabrics
-    "Gore-Tex", "Softshell", "Down", "Feathers", "Down fill",
-    
-    # Fur variations
-    "Fox fur", "Mink fur", "Rabbit fur", "Raccoon fur", "Faux fur",
-    "Fur trim", "Faux fur trim",
-]
-
-def extract_materials(text: str) -> list[str]:
-    t = text.lower()
-    found: list[str] = []
-    
-    # Sort by length (longest first) to match compound materials before simple ones
-    for m in sorted(MATERIALS, key=len, reverse=True):
-        m_lower = m.lower()
-        escaped = re.escape(m_lower)
-        # Replace escaped spaces with flexible whitespace
-        escaped = escaped.replace(r'\ ', r'\s+')
-        
-        # Use word boundaries to prevent matching within words
-        pattern = r'\b' + escaped + r'\b'
-        
-        if re.search(pattern, t) and m not in found:
-            found.append(m)
-    
-    return found
+    metafields_payload = build_metafields_payload(product_id, text)
 
-def build_metafields_payload(product_id: int, text: str) -> dict:
-    designer = extract_designer(text)
-    condition = extract_condition(text)
-    colors = extract_colors(text)
-    ptype = extract_type(text)
-    era = extract_era(text)
-    materials = extract_materials(text)
-
-    metafields: list[dict] = []
-
-    def add_field(key: str, value, type_: str = "single_line_text_field"):
-        if value is None:
-            return
-        metafields.append({
-            "namespace": "custom",
-            "key": key,
-            "type": type_,
-            "value": str(value),
-        })
-
-    add_field("designer", designer)
-    add_field("condition_rating", condition)
-    if colors:
-        add_field("color", colors[0])
-    add_field("product_type", ptype)
-    add_field("season", era)
-    if materials:
-        add_field("material", ", ".join(materials))
-
-    return {"product_id": product_id, "metafields": metafields}
-
-async def write_metafields_to_shopify(product_id: int, metafields: list[dict]):
-    if not SHOPIFY_API_TOKEN or not SHOPIFY_STORE_DOMAIN:
-        print("Shopify credentials missing; skipping metafield write.")
-        return
+    # Recorded before writing, since the echo can arrive before the write returns
+    fingerprint = product_fingerprint(title, body_html, metafields_payload["vocabulary_version"])
+    written_fingerprints.set(product_id, fingerprint)
+    try:
+        results = await write_metafields_to_shopify(
+            product_id=metafields_payload["product_id"],
+            metafields=metafields_payload["metafields"],
+        )
+    except Exception:
+        written_fingerprints.pop(product_id)
+        raise
+    if not results or not all(r["ok"] for r in results):
+        written_fingerprints.pop(product_id)
+
+async def webhook_worker():
+    while True:
+        enqueued_at, data = await webhook_queue.get()
+        webhook_stats["lag_seconds"] = time.monotonic() - enqueued_at
+        try:
+            with IN_FLIGHT.track_inprogress(stage="webhook_job"):
+                await process_product_webhook(data)
+            webhook_stats["processed"] += 1
+        except Exception as e:
+            webhook_stats["failed"] += 1
+            print(f"Webhook job failed for product {data.get('id')}: {e!r}")
+        finally:
+            webhook_queue.task_done()
 
-    base_url = f"https://{SHOPIFY_STORE_DOMAIN}/admin/api/2025-10/products/{product_id}/metafields.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_TOKEN,
-        "Content-Type": "application/json",
+@app.get("/health")
+def health():
+    return {
+        "status": "ok",
+        "webhook_queue": {
+            "depth": webhook_queue.qsize() if webhook_queue else 0,
+            "capacity": WEBHOOK_QUEUE_SIZE,
+            "workers": WEBHOOK_WORKERS,
+            **webhook_stats,
+        },
+        "extraction_cache": extraction_cache.stats(),
+        "vocabulary_version": get_vocabulary().version,
     }
 
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        for mf in metafields:
-            payload = {"metafield": mf}
-            print(f"Attempting to create metafield: {mf['key']} = {mf['value']}")
-            resp = await client.post(base_url, headers=headers, json=payload)
-            if resp.status_code >= 300:
-                print(f"Error from Shopify metafields: {resp.status_code} {resp.text}")
-            else:
-                print(f"Successfully created metafield: {mf['key']}")
+IN_FLIGHT.set_function(lambda: webhook_queue.qsize() if webhook_queue else 0, stage="webhook_queued")
 
-@app.get("/health")
-def health():
-    return {"status": "ok"}
+@app.get("/metrics")
+def metrics():
+    return Response(content=render_metrics(), media_type=CONTENT_TYPE)
 
 @app.post("/webhooks/products")
 async def handle_product_webhook(request: Request):
     raw_body = await request.body()
     hmac_header = request.headers.get("x-shopify-hmac-sha256")
     
-    if not hmac_header or not verify_shopify_hmac(raw_body, hmac_header):
+    with STAGE_SECONDS.time(stage="hmac_verify"):
+        verified = bool(hmac_header) and verify_shopify_hmac(raw_body, hmac_header)
+    if not verified:
         print("HMAC verification failed!")
         raise HTTPException(status_code=401, detail="Invalid HMAC")
 
     try:
-        data = json.loads(raw_body.decode("utf-8"))
+        with STAGE_SECONDS.time(stage="json_decode"):
+            data = json.loads(raw_body.decode("utf-8"))
     except json.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
-    product_id = data.get("id")
-    title = data.get("title") or ""
-    body_html = data.get("body_html") or ""
-
-    body_text = re.sub(r"<[^>]+>", " ", body_html)
-    text = f"{title}\n{body_text}"
-
-    metafields_payload = build_metafields_payload(product_id, text)
-    await write_metafields_to_shopify(
-        product_id=metafields_payload["product_id"],
-        metafields=metafields_payload["metafields"],
-    )
+    webhook_id = request.headers.get("x-shopify-webhook-id")
+    if webhook_id:
+        # Marked now so concurrent redeliveries (to any worker) are dropped;
+        # forgotten again below whenever Shopify is told to retry
+        if not seen_webhooks.add(webhook_id, True):
+            webhook_stats["duplicates"] += 1
+            return {"status": "duplicate"}
+
+    # Our own metafield writes come back as products/update with the same title/body
+    fingerprint = product_fingerprint(data.get("title") or "", data.get("body_html") or "")
+    if written_fingerprints.get(data.get("id")) == fingerprint:
+        webhook_stats["echoes"] += 1
+        return {"status": "unchanged"}
+
+    # Without the workers (app started without its lifespan) handle it inline
+    if webhook_queue is None:
+        try:
+            with IN_FLIGHT.track_inprogress(stage="webhook_job"):
+                await process_product_webhook(data)
+        except BaseException:
+            if webhook_id:
+                seen_webhooks.pop(webhook_id)
+            raise
+        return {"status": "processed"}
+
+    job = (time.monotonic(), data)
+    if WEBHOOK_QUEUE_FULL == "wait":
+        try:
+            await webhook_queue.put(job)
+        except BaseException:
+            # Client went away or shutdown while waiting; the delivery wasn't taken
+            if webhook_id:
+                seen_webhooks.pop(webhook_id)
+            raise
+    else:
+        try:
+            webhook_queue.put_nowait(job)
+        except asyncio.QueueFull:
+            if webhook_id:
+                seen_webhooks.pop(webhook_id)
+            webhook_stats["rejected"] += 1
+            print("Webhook queue full; asking Shopify to retry")
+            raise HTTPException(status_code=503, detail="Webhook queue full")
+
+    return {"status": "queued"}
+
+@app.post("/admin/vocabulary/reload")
+async def admin_reload_vocabulary(request: Request):
+    """Load changed vocabulary files without a restart."""
+    if not verify_admin_token(request.headers.get("authorization", "")):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+    try:
+        return await apply_vocabulary_reload()
+    except Exception as e:
+        raise HTTPException(
+            status_code=422, detail=f"Vocabulary not reloaded, still on {get_vocabulary().version}: {e!r}",
+        )
+
+@app.post("/extract")
+async def extract_products(request: Request):
+    """Extract metafields for a JSON array or NDJSON stream of products.
+
+    Results come back in the same format as the request. Nothing is written
+    to Shopify. Needs the EXTRACT_TOKEN bearer token.
+    """
+    if not verify_bearer_token(request.headers.get("authorization", ""), EXTRACT_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid token")
+    too_large = HTTPException(status_code=413, detail=f"Request body over {EXTRACT_MAX_BYTES} bytes")
+    if int(request.headers.get("content-length") or 0) > EXTRACT_MAX_BYTES:
+        raise too_large
+    # Counted as it arrives too, for chunked bodies without a Content-Length
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > EXTRACT_MAX_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    raw_body = b"".join(chunks)
+    ndjson = not raw_body.lstrip().startswith(b"[")
 
-    return {"status": "processed"}
+    try:
+        if ndjson:
+            products = [json.loads(line) for line in raw_body.decode("utf-8").splitlines() if line.strip()]
+        else:
+            products = json.loads(raw_body.decode("utf-8"))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not all(isinstance(product, dict) for product in products):
+        raise HTTPException(status_code=400, detail="Each product must be a JSON object")
+    if len(products) > EXTRACT_MAX_PRODUCTS:
+        raise HTTPException(status_code=413, detail=f"More than {EXTRACT_MAX_PRODUCTS} products")
+
+    # Each product needs id, title and body_html as in Shopify's product JSON.
+    # extract_batch leaves extraction_cache alone, so a large batch can't
+    # evict the webhooks' working set
+    batch = [(product.get("id"), product.get("title"), product.get("body_html")) for product in products]
+    with IN_FLIGHT.track_inprogress(stage="extract_batch"):
+        results = await run_in_threadpool(extract_batch, batch)
+
+    if ndjson:
+        body = "".join(json.dumps(result) + "\n" for result in results)
+        return Response(content=body, media_type="application/x-ndjson")
+    return results
@@ -0,0 +1,253 @@
+# metrics.py - Prometheus text-format metrics shared by the webhook and the bulk processor
+
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Latency buckets in seconds; extraction runs in tens of microseconds, Shopify calls in hundreds of ms
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Directory where each serving process publishes its metrics, so whichever
+# worker answers a scrape reports them all (empty = single process)
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+# Seconds between those snapshots
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "1"))
+
+REGISTRY = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _label_str(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[n] for n in self.labelnames)
+
+    def collect(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def render(self, values: dict | None = None) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted((self.collect() if values is None else values).items()):
+            lines.append(f"{self.name}{_label_str(self.labelnames, key)} {value}")
+        return lines
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self._functions = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        """Read the value from fn() at scrape time."""
+        self._functions[self._key(labels)] = fn
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def collect(self) -> dict:
+        for key, fn in self._functions.items():
+            self.set(fn(), **dict(zip(self.labelnames, key)))
+        return super().collect()
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), then the sum
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """Decorator form of time()."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def collect(self) -> dict:
+        with self._lock:
+            return {k: list(v) for k, v in self._values.items()}
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+    def render(self, values: dict | None = None) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted((self.collect() if values is None else values).items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames, key, le)} {cumulative}")
+            labels = _label_str(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+def write_snapshot():
+    """Publish this process's metrics to METRICS_DIR."""
+    snapshot = {m.name: [[list(k), v] for k, v in m.collect().items()] for m in REGISTRY}
+    path = _snapshot_path(os.getpid())
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+def _flush_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError as e:
+            print(f"⚠️ Could not write metrics snapshot: {e!r}")
+
+def start_multiprocess():
+    """Start publishing this worker's metrics; call once in each worker after fork."""
+    if METRICS_DIR:
+        write_snapshot()
+        threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+def mark_process_dead(pid: int):
+    """Keep an exited worker's counters and histograms but stop reporting its gauges."""
+    if METRICS_DIR and os.path.exists(_snapshot_path(pid)):
+        os.replace(_snapshot_path(pid), os.path.join(METRICS_DIR, f"dead-{pid}-{time.time_ns()}.json"))
+
+def _merged() -> dict:
+    """This process's live values plus every other process's last snapshot."""
+    merged = {m.name: m.collect() for m in REGISTRY}
+    own = _snapshot_path(os.getpid())
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        dead = os.path.basename(path).startswith("dead-")
+        for metric in REGISTRY:
+            if dead and metric.kind == "gauge":
+                continue
+            values = merged[metric.name]
+            for key, value in snapshot.get(metric.name, ()):
+                key = tuple(key)
+                values[key] = metric.merge(values[key], value) if key in values else value
+    return merged
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format.
+
+    With METRICS_DIR set, counters, histograms and gauges are summed over
+    all worker processes; exited workers still count towards counters and
+    histograms.
+    """
+    merged = _merged() if METRICS_DIR else {}
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render(merged.get(metric.name)))
+    return "\n".join(lines) + "\n"
+
+# Content type of render()'s output
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = Histogram(
+    "lsf_stage_seconds", "Time spent in each processing stage.", ("stage",),
+)
+SHOPIFY_REQUEST_SECONDS = Histogram(
+    "lsf_shopify_request_seconds", "Shopify Admin API request latency, per attempt.", ("call",),
+)
+METAFIELD_WRITES = Counter(
+    "lsf_metafield_writes_total", "Metafield writes by HTTP status (user_error for GraphQL userErrors).", ("status",),
+)
+SHOPIFY_THROTTLED = Counter(
+    "lsf_shopify_throttled_total", "429 and THROTTLED responses from Shopify.", ("kind",),
+)
+SHOPIFY_RETRIES = Counter(
+    "lsf_shopify_retries_total", "Shopify requests retried after being throttled.", ("kind",),
+)
+VOCABULARY_RELOADS = Counter(
+    "lsf_vocabulary_reloads_total", "Vocabulary reload attempts by outcome (reloaded, unchanged, failed).", ("status",),
+)
+IN_FLIGHT = Gauge(
+    "lsf_in_flight", "Work currently in progress.", ("stage",),
+)
@@ -0,0 +1,89 @@
+# normalize.py - One normalization pass over product text, shared by every extractor
+
+import re
+import unicodedata
+
+# Combining marks left behind by NFKD (é -> e + U+0301), dropped to fold accents
+_COMBINING_RE = re.compile("[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]+")
+
+# Letters NFKD leaves whole, and punctuation variants mapped to their ASCII form
+_FOLD_MAP = {
+    "æ": "ae", "œ": "oe", "ø": "o", "ł": "l", "đ": "d", "ð": "d", "þ": "th", "ı": "i",
+    "‘": "'", "’": "'", "‚": "'", "‛": "'", "′": "'",
+    "“": '"', "”": '"', "„": '"', "‟": '"', "″": '"', "«": '"', "»": '"',
+    "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "―": "-", "−": "-",
+    "⁄": "/", "∕": "/",
+}
+_FOLD_RE = re.compile("[" + "".join(map(re.escape, _FOLD_MAP)) + "]")
+
+def _fold(text: str) -> str:
+    text = text.casefold()
+    if not text.isascii():
+        # Regex passes rather than str.translate, which is several times slower here
+        text = _COMBINING_RE.sub("", unicodedata.normalize("NFKD", text))
+        text = _FOLD_RE.sub(lambda m: _FOLD_MAP[m.group()], text)
+    return text
+
+class NormalizedText:
+    """Product text as every extractor reads it.
+
+    ``text`` is casefolded and accent-folded, with curly quotes, dashes and
+    similar punctuation in their ASCII form and each run of whitespace
+    replaced by one space. ``offsets[i]`` is the index in ``original`` that
+    ``text[i]`` came from; it is only built when first read.
+    """
+
+    __slots__ = ("original", "text", "_offsets")
+
+    def __init__(self, original: str):
+        self.original = original
+        self.text = " ".join(_fold(original).split())
+        self._offsets = None
+
+    @property
+    def offsets(self) -> list[int]:
+        if self._offsets is None:
+            # Same folding as __init__, one source character at a time
+            chars: list[str] = []
+            offsets: list[int] = []
+            space = False
+            for i, ch in enumerate(self.original):
+                for out in _fold(ch):
+                    if out.isspace():
+                        space = bool(chars)
+                        continue
+                    if space:
+                        chars.append(" ")
+                        offsets.append(i)
+                        space = False
+                    chars.append(out)
+                    offsets.append(i)
+            self._offsets = offsets
+        return self._offsets
+
+    def span(self, start: int, end: int) -> tuple[int, int]:
+        """Original-text span of text[start:end]."""
+        return self.offsets[start], self.offsets[end - 1] + 1
+
+def normalize(text) -> NormalizedText:
+    """Normalize text once; already-normalized text is returned as is."""
+    if isinstance(text, NormalizedText):
+        return text
+    return NormalizedText(text)
+
+def normalize_phrase(phrase: str) -> str:
+    """A vocabulary entry folded exactly like product text."""
+    return NormalizedText(phrase).text
+
+def normalize_vocabulary(entries) -> dict:
+    """Map normalized phrase -> value, keeping the first of any entries that fold together.
+
+    entries is a dict (phrase -> value) or a list of display names (each its own value).
+    """
+    items = entries.items() if isinstance(entries, dict) else ((e, e) for e in entries)
+    vocabulary = {}
+    for phrase, value in items:
+        key = normalize_phrase(phrase)
+        if key and key not in vocabulary:
+            vocabulary[key] = value
+    return vocabulary
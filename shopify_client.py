@@ -0,0 +1,374 @@
+# shopify_client.py - Shopify Admin API calls shared by the webhook and the bulk processor
+
+import os
+import re
+import time
+import asyncio
+from contextlib import asynccontextmanager
+import httpx
+
+from cache import Cache, SharedCache, shared_cache
+
+from metrics import IN_FLIGHT, METAFIELD_WRITES, SHOPIFY_REQUEST_SECONDS, SHOPIFY_RETRIES, SHOPIFY_THROTTLED
+
+API_VERSION = "2025-10"
+
+# Overrides https://{store}/admin/api/{version}, e.g. to point at a local stand-in server
+SHOPIFY_ADMIN_URL = os.environ.get("SHOPIFY_ADMIN_URL", "")
+
+# "graphql" writes all of a product's metafields in one metafieldsSet call,
+# "rest" posts them one at a time (also used when the GraphQL call fails)
+METAFIELD_WRITER = os.environ.get("METAFIELD_WRITER", "graphql")
+
+# Shared HTTP client: connection pool size, idle keep-alive connections
+# (and how long they stay open), per-request timeout and optional HTTP/2,
+# which needs the h2 package (pip install "httpx[http2]")
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "30"))
+HTTP2 = os.environ.get("HTTP2", "") == "1"
+
+# Fraction of each rate-limit bucket we allow ourselves to fill
+RATE_LIMIT_HEADROOM = float(os.environ.get("RATE_LIMIT_HEADROOM", "0.9"))
+# Retries after a 429 / THROTTLED response
+RATE_LIMIT_RETRIES = int(os.environ.get("RATE_LIMIT_RETRIES", "5"))
+# Query cost assumed before Shopify reports the actual one (metafieldsSet is 10)
+GRAPHQL_COST_ESTIMATE = 10.0
+
+# Where current metafield values come from when deciding what to write:
+# "memory" = what was last written (kept by the server, shared by its workers
+# through SHARED_STATE_DIR, or in the run-state database for bulk runs), "shopify" = that, else one read of the product's
+# custom namespace, "none" = always write every field
+WRITE_PLAN_SOURCE = os.environ.get("WRITE_PLAN_SOURCE", "memory")
+# Products whose last-written values are kept
+WRITTEN_VALUES_SIZE = int(os.environ.get("WRITTEN_VALUES_SIZE", "100000"))
+
+# metafieldsSet accepts at most 25 metafields per call
+METAFIELDS_SET_LIMIT = 25
+
+PRODUCT_METAFIELDS_QUERY = """
+query ProductMetafields($id: ID!) {
+  product(id: $id) {
+    metafields(first: 50, namespace: "custom") { nodes { key value } }
+  }
+}
+"""
+
+METAFIELDS_SET_MUTATION = """
+mutation MetafieldsSet($metafields: [MetafieldsSetInput!]!) {
+  metafieldsSet(metafields: $metafields) {
+    metafields { key namespace }
+    userErrors { field message code }
+  }
+}
+"""
+
+def admin_url(store_domain: str) -> str:
+    """Base URL of the Admin API for a store."""
+    if SHOPIFY_ADMIN_URL:
+        return SHOPIFY_ADMIN_URL.rstrip("/")
+    return f"https://{store_domain}/admin/api/{API_VERSION}"
+
+_client: httpx.AsyncClient | None = None
+
+def create_client(transport: httpx.AsyncBaseTransport | None = None) -> httpx.AsyncClient:
+    """Build a pooled keep-alive client from the HTTP_* settings.
+
+    transport replaces the network, e.g. with httpx.MockTransport in tests.
+    """
+    http2 = HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            print("HTTP2=1 but the h2 package is not installed; using HTTP/1.1")
+            http2 = False
+    # httpx asks for gzip/deflate (and br/zstd when installed) and decodes them
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        transport=transport,
+    )
+
+def get_client() -> httpx.AsyncClient:
+    """The process-wide client, created on first use outside the app lifespan."""
+    global _client
+    if _client is None:
+        _client = create_client()
+    return _client
+
+@asynccontextmanager
+async def lifespan(app):
+    """FastAPI lifespan hook: open the shared client at startup, close it at shutdown."""
+    global _client
+    _client = create_client()
+    try:
+        yield
+    finally:
+        await _client.aclose()
+        _client = None
+
+class _Bucket:
+    """Client-side copy of one of Shopify's leaky buckets."""
+
+    def __init__(self, capacity: float, leak_rate: float):
+        self.capacity = capacity
+        self.leak_rate = leak_rate
+        self.level = 0.0
+        self.updated_at = time.monotonic()
+
+    def level_at(self, now: float) -> float:
+        return max(0.0, self.level - (now - self.updated_at) * self.leak_rate)
+
+    def update(self, level: float, capacity: float, leak_rate: float | None = None):
+        self.level, self.capacity = level, capacity
+        if leak_rate:
+            self.leak_rate = leak_rate
+        self.updated_at = time.monotonic()
+
+class RateLimiter:
+    """Paces Shopify calls to just under the store's rate limits.
+
+    Tracks the REST bucket from X-Shopify-Shop-Api-Call-Limit and the GraphQL
+    bucket from extensions.cost.throttleStatus. Each acquire() reserves its
+    cost up front, so concurrent callers queue up behind each other without
+    a lock. A 429 blocks every caller until its Retry-After has passed.
+    """
+
+    def __init__(self, headroom: float = RATE_LIMIT_HEADROOM):
+        self.headroom = headroom
+        # Standard-plan defaults until Shopify reports the real numbers
+        self.buckets = {"rest": _Bucket(40, 2.0), "graphql": _Bucket(1000, 50.0)}
+        self.retry_at = 0.0
+
+    async def acquire(self, kind: str, cost: float = 1.0):
+        bucket = self.buckets[kind]
+        now = time.monotonic()
+        level = bucket.level_at(now)
+        limit = bucket.capacity * self.headroom
+        delay = max(0.0, (level + cost - limit) / bucket.leak_rate, self.retry_at - now)
+        bucket.level, bucket.updated_at = level + cost, now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def observe(self, kind: str, resp: httpx.Response) -> bool:
+        """Update the buckets from a response; returns True if it was throttled."""
+        throttled = resp.status_code == 429
+        if throttled:
+            try:
+                retry_after = float(resp.headers.get("Retry-After", "1"))
+            except ValueError:
+                retry_after = 1.0
+            self.retry_at = max(self.retry_at, time.monotonic() + retry_after)
+
+        if kind == "rest":
+            used, _, capacity = resp.headers.get("X-Shopify-Shop-Api-Call-Limit", "").partition("/")
+            if used.isdigit() and capacity.isdigit():
+                self.buckets["rest"].update(float(used), float(capacity))
+        elif resp.status_code == 200:
+            try:
+                body = resp.json()
+            except ValueError:
+                return throttled
+            status = ((body.get("extensions") or {}).get("cost") or {}).get("throttleStatus")
+            if status:
+                maximum = float(status["maximumAvailable"])
+                self.buckets["graphql"].update(
+                    maximum - float(status["currentlyAvailable"]), maximum, float(status["restoreRate"]),
+                )
+            errors = body.get("errors") or []
+            throttled = any((e.get("extensions") or {}).get("code") == "THROTTLED" for e in errors)
+        return throttled
+
+# One limiter per process: every Shopify call from this app shares the budget
+rate_limiter = RateLimiter()
+
+_OPERATION_RE = re.compile(r"\b(?:query|mutation)\s+(\w+)")
+_ID_RE = re.compile(r"/\d+")
+
+def _call_name(method: str, url: str, body) -> str:
+    """Metrics label for a request: the GraphQL operation, or method and path with ids elided."""
+    if isinstance(body, dict) and "query" in body:
+        match = _OPERATION_RE.search(body["query"])
+        return match.group(1) if match else "graphql"
+    path = httpx.URL(url).path.split(f"/admin/api/{API_VERSION}", 1)[-1]
+    return f"{method} {_ID_RE.sub('/:id', path)}"
+
+async def shopify_request(client: httpx.AsyncClient, method: str, url: str, kind: str = "rest",
+                          cost: float = 1.0, **kwargs) -> httpx.Response:
+    """Send an Admin API request through the rate limiter, retrying when throttled."""
+    call = _call_name(method, url, kwargs.get("json"))
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        await rate_limiter.acquire(kind, cost)
+        with IN_FLIGHT.track_inprogress(stage="shopify_request"), SHOPIFY_REQUEST_SECONDS.time(call=call):
+            resp = await client.request(method, url, **kwargs)
+        throttled = rate_limiter.observe(kind, resp)
+        if throttled:
+            SHOPIFY_THROTTLED.inc(kind=kind)
+        if not throttled or attempt == RATE_LIMIT_RETRIES:
+            return resp
+        SHOPIFY_RETRIES.inc(kind=kind)
+        print(f"Throttled by Shopify; retrying ({attempt + 1}/{RATE_LIMIT_RETRIES})")
+    return resp
+
+def _headers(api_token: str) -> dict:
+    return {
+        "X-Shopify-Access-Token": api_token,
+        "Content-Type": "application/json",
+    }
+
+async def graphql(client: httpx.AsyncClient, store_domain: str, api_token: str,
+                  query: str, variables: dict | None = None,
+                  cost: float = GRAPHQL_COST_ESTIMATE) -> dict:
+    """Run an Admin GraphQL query; raises on HTTP errors and returns the parsed body."""
+    resp = await shopify_request(client, "POST", f"{admin_url(store_domain)}/graphql.json",
+                                 kind="graphql", cost=cost, headers=_headers(api_token),
+                                 json={"query": query, "variables": variables or {}})
+    resp.raise_for_status()
+    return resp.json()
+
+async def set_metafields_rest(client: httpx.AsyncClient, store_domain: str, api_token: str,
+                              product_id: int, metafields: list[dict]) -> list[dict]:
+    """POST each metafield separately; returns one result per field."""
+    url = f"{admin_url(store_domain)}/products/{product_id}/metafields.json"
+    results = []
+    for mf in metafields:
+        resp = await shopify_request(client, "POST", url, headers=_headers(api_token),
+                                     json={"metafield": mf})
+        METAFIELD_WRITES.inc(status=str(resp.status_code))
+        if resp.status_code < 300:
+            results.append({"key": mf["key"], "ok": True, "error": None})
+        else:
+            results.append({"key": mf["key"], "ok": False, "error": f"{resp.status_code} {resp.text}"})
+    return results
+
+def metafields_set_results(keys: list[str], user_errors: list[dict]) -> list[dict]:
+    """Per-field results of one metafieldsSet call, given its userErrors."""
+    # userErrors point at a field as ["metafields", "<index>", "<attribute>"]
+    errors: dict[int, list[str]] = {}
+    for err in user_errors:
+        path = err.get("field") or []
+        index = int(path[1]) if len(path) > 1 and str(path[1]).isdigit() else -1
+        errors.setdefault(index, []).append(err.get("message", ""))
+
+    # metafieldsSet is atomic: one rejected field means none were written
+    results = []
+    for i, key in enumerate(keys):
+        if i in errors:
+            results.append({"key": key, "ok": False, "error": "; ".join(errors[i])})
+        elif errors:
+            unplaced = "; ".join(errors.get(-1, [])) or "another field in the call was rejected"
+            results.append({"key": key, "ok": False, "error": f"not written: {unplaced}"})
+        else:
+            results.append({"key": key, "ok": True, "error": None})
+    return results
+
+async def set_metafields_graphql(client: httpx.AsyncClient, store_domain: str, api_token: str,
+                                 product_id: int, metafields: list[dict]) -> list[dict] | None:
+    """Write metafields with metafieldsSet; returns one result per field.
+
+    Returns None when the request itself fails (HTTP error or top-level
+    GraphQL errors) so the caller can fall back to REST.
+    """
+    url = f"{admin_url(store_domain)}/graphql.json"
+    owner_id = f"gid://shopify/Product/{product_id}"
+    results = []
+    for start in range(0, len(metafields), METAFIELDS_SET_LIMIT):
+        batch = metafields[start:start + METAFIELDS_SET_LIMIT]
+        variables = {"metafields": [{"ownerId": owner_id, **mf} for mf in batch]}
+        resp = await shopify_request(client, "POST", url, kind="graphql", cost=GRAPHQL_COST_ESTIMATE,
+                                     headers=_headers(api_token),
+                                     json={"query": METAFIELDS_SET_MUTATION, "variables": variables})
+        if resp.status_code != 200:
+            print(f"metafieldsSet failed: {resp.status_code} {resp.text}")
+            return None
+        body = resp.json()
+        outcome = (body.get("data") or {}).get("metafieldsSet")
+        if body.get("errors") or outcome is None:
+            print(f"metafieldsSet failed: {body.get('errors')}")
+            return None
+
+        user_errors = outcome.get("userErrors") or []
+        METAFIELD_WRITES.inc(len(batch), status="user_error" if user_errors else "200")
+        results.extend(metafields_set_results([mf["key"] for mf in batch], user_errors))
+    return results
+
+async def write_metafields(client: httpx.AsyncClient, store_domain: str, api_token: str,
+                           product_id: int, metafields: list[dict],
+                           writer: str = METAFIELD_WRITER) -> list[dict]:
+    """Write a product's metafields with the configured backend.
+
+    Each result is {"key", "ok", "error"}.
+    """
+    if not metafields:
+        return []
+    if writer == "graphql":
+        results = await set_metafields_graphql(client, store_domain, api_token,
+                                               product_id, metafields)
+        if results is not None:
+            return results
+        print(f"Falling back to REST metafield writes for product {product_id}")
+    return await set_metafields_rest(client, store_domain, api_token,
+                                     product_id, metafields)
+
+# Metafield values last written, per product
+written_values = shared_cache("written_values", WRITTEN_VALUES_SIZE)
+
+async def read_product_metafields(client: httpx.AsyncClient, store_domain: str, api_token: str,
+                                  product_id: int) -> dict[str, str] | None:
+    """Current custom-namespace metafield values of a product, or None if the read fails."""
+    try:
+        body = await graphql(client, store_domain, api_token, PRODUCT_METAFIELDS_QUERY,
+                             {"id": f"gid://shopify/Product/{product_id}"}, cost=3.0)
+    except httpx.HTTPError as e:
+        print(f"Could not read metafields of product {product_id}: {e!r}")
+        return None
+    product = (body.get("data") or {}).get("product")
+    if body.get("errors") or product is None:
+        return None
+    return {node["key"]: node["value"] for node in product["metafields"]["nodes"]}
+
+def plan_writes(metafields: list[dict], current: dict[str, str]) -> list[dict]:
+    """The metafields whose value differs from the current one."""
+    return [mf for mf in metafields if current.get(mf["key"]) != mf["value"]]
+
+async def write_changed_metafields(client: httpx.AsyncClient, store_domain: str, api_token: str,
+                                   product_id: int, metafields: list[dict],
+                                   current: dict[str, str] | None = None,
+                                   source: str = WRITE_PLAN_SOURCE,
+                                   values: Cache | SharedCache | None = None) -> list[dict]:
+    """Write only the metafields whose value changed.
+
+    current is used when the caller already has it (e.g. from a bulk
+    export); otherwise it comes from WRITE_PLAN_SOURCE. values is where
+    last-written values are kept (anything with Cache's get/set),
+    by default written_values. Unchanged fields get
+    {"ok": True, "skipped": True} results without an API call.
+    """
+    if values is None:
+        values = written_values
+    if source == "none":
+        current = {}
+    elif current is None:
+        current = values.get(product_id)
+        if current is None and source == "shopify":
+            current = await read_product_metafields(client, store_domain, api_token, product_id)
+    changed = plan_writes(metafields, current or {})
+
+    written = {r["key"]: r for r in await write_metafields(client, store_domain, api_token,
+                                                               product_id, changed)}
+    if source != "none":
+        values.set(product_id, {**(current or {}), **{
+            mf["key"]: mf["value"] for mf in metafields
+            if mf["key"] not in written or written[mf["key"]]["ok"]
+        }})
+    return [
+        written.get(mf["key"]) or {"key": mf["key"], "ok": True, "error": None, "skipped": True}
+        for mf in metafields
+    ]
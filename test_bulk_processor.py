@@ -0,0 +1,165 @@
+# test_bulk_processor.py - The Bulk Operations backfill against a mocked Shopify
+
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import bulk_processor
+import shopify_client
+from bulk_jobs import Progress
+from bulk_state import RunState
+from catalog import ProductRecord
+from extraction import extract_batch
+
+EXPORT_URL = "https://storage.test/export.jsonl"
+UPLOAD_URL = "https://storage.test/upload"
+RESULT_URL = "https://storage.test/result.jsonl"
+
+def gid(product_id):
+    return f"gid://shopify/Product/{product_id}"
+
+class FakeShopify:
+    """Answers the GraphQL calls, the export, the staged upload and the mutation result."""
+
+    def __init__(self, export_rows, rejected_lines=()):
+        self.export = "".join(json.dumps(row) + "\n" for row in export_rows)
+        self.rejected_lines = set(rejected_lines)
+        self.submitted = []  # variables lines of the bulk mutation, in order
+        self.urls = {}
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        if url.endswith("/graphql.json"):
+            body = json.loads(request.content)
+            return httpx.Response(200, json=self.graphql(body["query"], body["variables"]))
+        if url == EXPORT_URL:
+            return httpx.Response(200, text=self.export)
+        if url == UPLOAD_URL:
+            # The multipart body holds the variables file; keep its JSONL lines
+            self.submitted = [json.loads(line) for line in request.content.splitlines()
+                              if line.startswith(b'{"metafields"')]
+            return httpx.Response(201)
+        if url == RESULT_URL:
+            rows = []
+            for line, variables in enumerate(self.submitted):
+                errors = [{"field": ["metafields", "0", "value"], "message": "invalid value"}] \
+                    if line in self.rejected_lines else []
+                rows.append({"data": {"metafieldsSet": {"metafields": [], "userErrors": errors}},
+                             "__lineNumber": line})
+            return httpx.Response(200, text="".join(json.dumps(row) + "\n" for row in rows))
+        return httpx.Response(404)
+
+    def graphql(self, query, variables):
+        if "bulkOperationRunQuery" in query:
+            self.urls["gid://shopify/BulkOperation/1"] = EXPORT_URL
+            return {"data": {"bulkOperationRunQuery": {
+                "bulkOperation": {"id": "gid://shopify/BulkOperation/1", "status": "CREATED"}, "userErrors": []}}}
+        if "stagedUploadsCreate" in query:
+            return {"data": {"stagedUploadsCreate": {"stagedTargets": [{
+                "url": UPLOAD_URL, "resourceUrl": None,
+                "parameters": [{"name": "key", "value": "tmp/variables.jsonl"}]}], "userErrors": []}}}
+        if "bulkOperationRunMutation" in query:
+            assert variables["path"] == "tmp/variables.jsonl"
+            self.urls["gid://shopify/BulkOperation/2"] = RESULT_URL
+            return {"data": {"bulkOperationRunMutation": {
+                "bulkOperation": {"id": "gid://shopify/BulkOperation/2", "status": "CREATED"}, "userErrors": []}}}
+        if "BulkOperationStatus" in query:
+            return {"data": {"node": {"id": variables["id"], "status": "COMPLETED", "objectCount": "0",
+                                      "url": self.urls[variables["id"]]}}}
+        raise AssertionError(f"unexpected query: {query}")
+
+@pytest.fixture
+def shopify(monkeypatch):
+    def install(fake):
+        monkeypatch.setattr(shopify_client, "_client", shopify_client.create_client(httpx.MockTransport(fake.handler)))
+        return fake
+
+    async def no_wait(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(bulk_processor, "SHOPIFY_STORE_DOMAIN", "test.myshopify.com")
+    monkeypatch.setattr(bulk_processor, "BULK_POLL_INTERVAL", 0)
+    monkeypatch.setattr(shopify_client.rate_limiter, "acquire", no_wait)
+    return install
+
+def product_row(product_id, title):
+    return {"id": gid(product_id), "title": title, "descriptionHtml": "<p>silk</p>",
+            "updatedAt": "2026-01-01T00:00:00Z"}
+
+def metafield_rows(product_id, metafields):
+    return [{"key": mf["key"], "value": mf["value"], "__parentId": gid(product_id)} for mf in metafields]
+
+def test_bulk_backfill(shopify):
+    current = extract_batch([(1, "Gucci red dress", "<p>silk</p>")])[0]["metafields"]
+    fake = shopify(FakeShopify([
+        # Already has every extracted value: nothing to submit
+        product_row(1, "Gucci red dress"),
+        *metafield_rows(1, current),
+        # A stray metafield row for another product must not be folded into product 2
+        product_row(2, "Prada black bag"),
+        *metafield_rows(99, [{"key": "designer", "value": "Prada"}]),
+        product_row(3, "Chanel white blouse"),
+    ], rejected_lines=[1]))
+    progress = Progress()
+    published = []
+
+    async def on_result(result):
+        published.append(result)
+
+    summary = asyncio.run(bulk_processor.run_bulk_backfill(workers=0, progress=progress, on_result=on_result))
+
+    assert [line["metafields"][0]["ownerId"] for line in fake.submitted] == [gid(2), gid(3)]
+    assert any(mf["key"] == "designer" for mf in fake.submitted[0]["metafields"])
+    assert summary["total_products"] == 3
+    assert summary["unchanged"] == 1
+    assert summary["submitted"] == 2
+    assert summary["failed"] == 1
+    # The rejected line 1 maps back to product 3
+    assert [e["product_id"] for e in summary["errors"]] == [3]
+    assert [r["product_id"] for r in published] == [2, 3]
+    assert published[0]["errors"] == {}
+    assert progress.processed == 2 and progress.skipped == 1 and progress.failed == 1
+
+def test_resumed_run_replays_unfinished_products_then_pages_on(shopify, monkeypatch, tmp_path):
+    cursor = "https://test.myshopify.com/admin/api/2025-10/products.json?limit=250&page_info=p2"
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.params.get("page_info"))
+        return httpx.Response(200, json={"products": [
+            {"id": 4, "title": "Prada black bag", "body_html": "", "updated_at": None},
+            {"id": 5, "title": "Chanel white blouse", "body_html": "", "updated_at": None},
+        ]})
+
+    written = {}
+
+    async def write(client, store_domain, api_token, product_id, metafields, values=None):
+        written[product_id] = metafields
+        return [{"key": mf["key"], "ok": True, "error": None} for mf in metafields]
+
+    monkeypatch.setattr(shopify_client, "_client", shopify_client.create_client(httpx.MockTransport(handler)))
+    monkeypatch.setattr(bulk_processor, "write_changed_metafields", write)
+
+    # An interrupted run: page 1 fetched, product 1 extracted but not written
+    state = RunState(str(tmp_path / "state.sqlite3"))
+    run = state.start()
+    state.record_page(run["run_id"], [ProductRecord(1, "Gucci red dress", ""), ProductRecord(2, "Gucci red dress", ""),
+                                      ProductRecord(3, "Dior blue scarf", "")], cursor)
+    stored = [{"namespace": "custom", "key": "designer", "type": "single_line_text_field", "value": "stored"}]
+    state.mark_extracted(run["run_id"], [{"product_id": 1, "title": "Gucci red dress", "metafields": stored}])
+
+    run = state.start(resume=True)
+    assert run["resumed"] and run["cursor"] == cursor
+    asyncio.run(bulk_processor.run_pipeline(workers=0, state=state, run=run))
+
+    # Paging picks up at the cursor; page 1 is not listed again
+    assert requested == ["p2"]
+    assert sorted(written) == [1, 2, 3, 4, 5]
+    # Extracted rows are written as stored, fetched rows extracted from the replay
+    assert written[1] == stored
+    assert {"key": "designer", "value": "Christian Dior"}.items() <= written[3][0].items()
+    assert state.counts(run["run_id"]) == {"written": 5}
+    assert state.finish(run["run_id"])
+    state.close()
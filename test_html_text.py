@@ -0,0 +1,39 @@
+# test_html_text.py - Edge cases of the product body HTML to text pass
+
+import pytest
+
+from html_text import html_to_text, product_text
+
+@pytest.mark.parametrize("html, text", [
+    ("", ""),
+    ("plain text", "plain text"),
+    ("<p>Red</p><p>silk</p>", "Red silk"),
+    ("<b>red</b>silk", "red silk"),
+    ("Dolce &amp; Gabbana&nbsp;dress", "Dolce & Gabbana dress"),
+    ("&lt;p&gt; is text", "<p> is text"),
+    ("size < 5 and 3 <4", "size < 5 and 3 <4"),
+    ("a<!-- hidden gucci -->b", "a b"),
+    ("a<!-- unclosed comment", "a"),
+    ("<script>var gucci = 1;</script>Prada", "Prada"),
+    ("<STYLE>.x{}</STYLE>Prada", "Prada"),
+    ("<svg><title>logo</title></svg>Prada", "Prada"),
+    ("Prada<script>never closed", "Prada"),
+    ("Prada <p unclosed", "Prada"),
+    ("  lots \n\n of\t space  ", "lots of space"),
+])
+def test_html_to_text(html, text):
+    assert html_to_text(html) == text
+
+def test_html_to_text_cuts_at_a_word_boundary():
+    assert html_to_text("<p>gucci handbag</p>", limit=12) == "gucci"
+    assert html_to_text("handbag", limit=3) == ""
+    assert html_to_text("gucci bag", limit=9) == "gucci bag"
+
+def test_html_to_text_stops_reading_past_the_limit():
+    assert html_to_text("<p>word</p>" * 100_000, limit=20) == "word word word word"
+
+def test_product_text_keeps_the_title_whole():
+    title = "Gucci red silk dress"
+    assert product_text(title, "<p>excellent condition</p>") == f"{title}\nexcellent condition"
+    assert product_text(title, "<p>excellent condition</p>", max_chars=len(title) + 10) == f"{title}\nexcellent"
+    assert product_text(title, "<p>body</p>", max_chars=5) == f"{title}\n"
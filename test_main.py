@@ -0,0 +1,76 @@
+# test_main.py - Webhook redelivery dedup and echo suppression
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+
+import httpx
+import pytest
+
+import main
+from cache import Cache
+
+SECRET = "test-secret"
+
+class FakeWriter:
+    """Records the products written; ok says whether Shopify accepts the writes."""
+
+    def __init__(self):
+        self.products = []
+        self.ok = True
+
+    async def __call__(self, product_id, metafields):
+        self.products.append(product_id)
+        return [{"key": mf["key"], "ok": self.ok, "error": None} for mf in metafields]
+
+@pytest.fixture
+def writes(monkeypatch):
+    writer = FakeWriter()
+    monkeypatch.setattr(main, "SHOPIFY_SECRET", SECRET)
+    monkeypatch.setattr(main, "write_metafields_to_shopify", writer)
+    monkeypatch.setattr(main, "seen_webhooks", Cache(100, 3600))
+    monkeypatch.setattr(main, "written_fingerprints", Cache(100, 3600))
+    monkeypatch.setattr(main, "webhook_queue", None)
+    return writer
+
+def deliver(*deliveries):
+    """POST each (webhook id, product) and return the response statuses."""
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            statuses = []
+            for webhook_id, product in deliveries:
+                body = json.dumps(product).encode()
+                signature = base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()).decode()
+                resp = await client.post("/webhooks/products", content=body, headers={
+                    "x-shopify-hmac-sha256": signature, "x-shopify-webhook-id": webhook_id,
+                })
+                statuses.append(resp.json().get("status") or resp.status_code)
+            return statuses
+    return asyncio.run(run())
+
+DRESS = {"id": 1, "title": "Gucci red silk dress", "body_html": "<p>excellent condition</p>"}
+
+def test_redelivery_is_dropped(writes):
+    assert deliver(("w1", DRESS), ("w1", DRESS)) == ["processed", "duplicate"]
+    assert writes.products == [1]
+
+def test_echo_of_our_own_write_is_dropped(writes):
+    edited = {**DRESS, "body_html": "<p>new with tags</p>"}
+    assert deliver(("w1", DRESS), ("w2", DRESS), ("w3", edited)) == ["processed", "unchanged", "processed"]
+    assert writes.products == [1, 1]
+
+def test_failed_write_is_not_taken_for_an_echo(writes):
+    writes.ok = False
+    assert deliver(("w1", DRESS), ("w2", DRESS)) == ["processed", "processed"]
+    assert writes.products == [1, 1]
+
+def test_delivery_refused_with_503_can_be_retried(writes, monkeypatch):
+    queue = asyncio.Queue(maxsize=1)
+    queue.put_nowait((0.0, {}))
+    monkeypatch.setattr(main, "webhook_queue", queue)
+    assert deliver(("w1", DRESS)) == [503]
+    queue.get_nowait()
+    assert deliver(("w1", DRESS), ("w1", DRESS)) == ["queued", "duplicate"]
@@ -0,0 +1,59 @@
+# test_matcher.py - Differential check of the token-index matcher against per-phrase regexes
+#
+#   python -m pytest
+
+import random
+import re
+
+import pytest
+
+import benchmark
+from extraction import _LOOKAROUND_FIELDS, _has_special_chars, get_vocabulary, load_sources
+from html_text import product_text
+from normalize import normalize
+
+def _reference_pattern(phrase: str, lookaround: bool) -> re.Pattern:
+    """The regex each phrase was matched with before the token index (\\b, or
+    non-word lookaround for designer phrases containing & - / .)."""
+    escaped = re.escape(phrase).replace(r"\ ", r"\s+")
+    if lookaround:
+        return re.compile(r"(?<!\w)" + escaped + r"(?!\w)")
+    return re.compile(r"\b" + escaped + r"\b")
+
+def _reference_patterns(vocab) -> dict[str, list[re.Pattern]]:
+    return {
+        field: [_reference_pattern(p, field in _LOOKAROUND_FIELDS and _has_special_chars(p)) for p in phrases]
+        for field, phrases in vocab.phrases.items()
+    }
+
+def _reference_scan(patterns: dict[str, list[re.Pattern]], text: str) -> dict[str, list[int]]:
+    return {
+        field: [i for i, pattern in enumerate(field_patterns) if pattern.search(text)]
+        for field, field_patterns in patterns.items()
+    }
+
+def _corpus() -> list[str]:
+    """Generated listings plus vocabulary phrases glued together with punctuation."""
+    texts = [product_text(p["title"], p["body_html"]) for p in benchmark.generate_listings(200, 7)]
+    rng = random.Random(3)
+    words = [w for entries in load_sources().values() for w in entries]
+    for _ in range(2000):
+        glue = rng.choice(["", " ", "x", "-", "&", ".", "/"])
+        texts.append(glue.join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+                     + rng.choice(["", ".", "-", "x", "&a"]))
+    return texts
+
+def test_scan_matches_regex_reference():
+    vocab = get_vocabulary()
+    patterns = _reference_patterns(vocab)
+    mismatches = []
+    for text in _corpus():
+        t = normalize(text).text
+        if vocab.scan(t) != _reference_scan(patterns, t):
+            mismatches.append(t[:80])
+    assert not mismatches, f"{len(mismatches)} texts differ, e.g. {mismatches[:3]}"
+
+@pytest.mark.parametrize("text", ["d&g", "xd&g", "t-shirt", "-t-shirt-", "a.p.c.", "off-white-", "y-3"])
+def test_scan_punctuation_edges_match_reference(text):
+    vocab = get_vocabulary()
+    assert vocab.scan(text) == _reference_scan(_reference_patterns(vocab), text)
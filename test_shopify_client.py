@@ -0,0 +1,105 @@
+# test_shopify_client.py - Rate limiter pacing and throttling retries
+
+import asyncio
+
+import httpx
+import pytest
+
+import shopify_client
+from shopify_client import RateLimiter
+
+class FakeClock:
+    """Stands in for time.monotonic and asyncio.sleep; sleeping moves the clock on unless frozen."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.frozen = False
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        if not self.frozen:
+            self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(shopify_client, "time", clock)
+    monkeypatch.setattr(shopify_client.asyncio, "sleep", clock.sleep)
+    return clock
+
+def test_acquire_paces_to_the_leak_rate(clock):
+    limiter = RateLimiter(headroom=1.0)
+
+    async def burst(n):
+        for _ in range(n):
+            await limiter.acquire("rest")
+
+    # The REST bucket holds 40 calls and drains 2 a second
+    asyncio.run(burst(40))
+    assert clock.sleeps == []
+    asyncio.run(burst(2))
+    assert clock.sleeps == [0.5, 0.5]
+
+def test_concurrent_callers_queue_behind_each_other(clock):
+    limiter = RateLimiter(headroom=1.0)
+
+    async def run():
+        for _ in range(40):
+            await limiter.acquire("rest")
+        # All three reserve before any of them has waited
+        clock.frozen = True
+        await asyncio.gather(*(limiter.acquire("rest") for _ in range(3)))
+
+    asyncio.run(run())
+    # Each reservation adds to the level before sleeping, so waits grow
+    assert clock.sleeps == [0.5, 1.0, 1.5]
+
+def test_observe_reads_the_rest_call_limit(clock):
+    limiter = RateLimiter(headroom=0.9)
+    limiter.observe("rest", httpx.Response(200, headers={"X-Shopify-Shop-Api-Call-Limit": "39/40"}))
+    asyncio.run(limiter.acquire("rest"))
+    # 39 used + 1 over a limit of 36, draining 2 a second
+    assert clock.sleeps == [2.0]
+
+def test_retry_after_holds_every_caller(clock):
+    limiter = RateLimiter()
+    assert limiter.observe("rest", httpx.Response(429, headers={"Retry-After": "3"}))
+
+    async def run():
+        await limiter.acquire("rest")
+        await limiter.acquire("graphql", cost=10)
+
+    asyncio.run(run())
+    assert clock.sleeps == [3.0]
+
+def test_graphql_throttled_error_is_detected(clock):
+    limiter = RateLimiter()
+    body = {
+        "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+        "extensions": {"cost": {"throttleStatus": {
+            "maximumAvailable": 1000.0, "currentlyAvailable": 0, "restoreRate": 50.0}}},
+    }
+    assert limiter.observe("graphql", httpx.Response(200, json=body))
+    assert limiter.buckets["graphql"].level == 1000.0
+
+def test_shopify_request_retries_after_a_429(clock, monkeypatch):
+    monkeypatch.setattr(shopify_client, "rate_limiter", RateLimiter())
+    calls = []
+
+    def handler(request):
+        calls.append(clock.now)
+        if len(calls) == 1:
+            return httpx.Response(429, headers={"Retry-After": "2"})
+        return httpx.Response(200, json={"ok": True})
+
+    async def run():
+        async with shopify_client.create_client(httpx.MockTransport(handler)) as client:
+            return await shopify_client.shopify_request(client, "GET", "https://test.myshopify.com/x.json")
+
+    resp = asyncio.run(run())
+    assert resp.status_code == 200
+    assert calls == [1000.0, 1002.0]